@@ -37,12 +37,21 @@ import gc
 import re
 import logging
 import json
-from dataclasses import dataclass
+import tempfile
+import functools
+import concurrent.futures
+import contextlib
+import struct
+from collections import deque
+from collections.abc import Mapping
+from dataclasses import dataclass, field
+from typing import Optional
 
 os.environ["JAX_PLATFORMS"] = "cpu"
 
 import numpy as np
 import jax
+import jax.numpy as jnp
 from jax import tree
 from flax.training import train_state
 import torch
@@ -50,7 +59,6 @@ import psutil
 from tqdm import tqdm
 
 import max_logging
-import max_utils
 from train import save_checkpoint
 import checkpointing
 from safetensors import safe_open
@@ -155,7 +163,22 @@ llama3_variants = {"llama3.1", "llama3.3"}
 
 SIMULATED_CPU_DEVICES_COUNT = 16
 
+# Llama and Mistral weights are released in bfloat16, keeping that dtype avoids a lossy round trip through float16.
+SAVE_DTYPE = jnp.bfloat16
 
+# Each layer converted concurrently keeps its source tensors in memory, so this bounds the extra memory use.
+MAX_CONVERSION_THREADS = 8
+# Threads reading the experts of a single MoE layer, each holds one expert's tensors at a time.
+MAX_EXPERT_THREADS = 4
+# Weights transferred to the devices before waiting on them, bounds the host weights kept alive by transfers in flight.
+DEVICE_PUT_BATCH_SIZE = 8
+
+
+# captures the layer and, for MoE weights, the expert index of a Mistral/Llama or Huggingface weight name
+_LAYER_EXPERT_RE = re.compile(r"layers\.(\d+)(?:\..*experts\.(\d+))?")
+
+
+@functools.lru_cache(maxsize=None)
 def _hf_mapping(layer_idx: int = -1, expert_idx: int = -1) -> dict:
   # pylint: disable=line-too-long
   return {
@@ -189,28 +212,135 @@ def _hf_mapping(layer_idx: int = -1, expert_idx: int = -1) -> dict:
   }
 
 
-def _hf_to_maxtext_mapping(layer_idx: int = -1, expert_idx: int = -1) -> dict:
-  # pylint: disable=line-too-long
-  return {
-      "model.embed_tokens.weight": "tok_embeddings.weight",
-      "model.norm.weight": "norm.weight",
-      "lm_head.weight": "output.weight",
-      f"model.layers.{layer_idx}.input_layernorm.weight": f"layers.{layer_idx}.attention_norm.weight",
-      f"model.layers.{layer_idx}.post_attention_layernorm.weight": f"layers.{layer_idx}.ffn_norm.weight",
-      f"model.layers.{layer_idx}.self_attn.q_proj.weight": f"layers.{layer_idx}.attention.wq.weight",
-      f"model.layers.{layer_idx}.self_attn.k_proj.weight": f"layers.{layer_idx}.attention.wk.weight",
-      f"model.layers.{layer_idx}.self_attn.v_proj.weight": f"layers.{layer_idx}.attention.wv.weight",
-      f"model.layers.{layer_idx}.self_attn.o_proj.weight": f"layers.{layer_idx}.attention.wo.weight",
-      f"model.layers.{layer_idx}.self_attn.rotary_emb.inv_freq": f"layers.{layer_idx}.attention.rotary_emb.inv_freq",
-      # MOE model
-      f"model.layers.{layer_idx}.block_sparse_moe.gate.weight": f"layers.{layer_idx}.feed_forward.gate.weight",
-      f"model.layers.{layer_idx}.block_sparse_moe.experts.{expert_idx}.w1.weight": f"layers.{layer_idx}.feed_forward.experts.{expert_idx}.w1.weight",
-      f"model.layers.{layer_idx}.block_sparse_moe.experts.{expert_idx}.w2.weight": f"layers.{layer_idx}.feed_forward.experts.{expert_idx}.w2.weight",
-      f"model.layers.{layer_idx}.block_sparse_moe.experts.{expert_idx}.w3.weight": f"layers.{layer_idx}.feed_forward.experts.{expert_idx}.w3.weight",
-      f"model.layers.{layer_idx}.mlp.gate_proj.weight": f"layers.{layer_idx}.feed_forward.w1.weight",
-      f"model.layers.{layer_idx}.mlp.down_proj.weight": f"layers.{layer_idx}.feed_forward.w2.weight",
-      f"model.layers.{layer_idx}.mlp.up_proj.weight": f"layers.{layer_idx}.feed_forward.w3.weight",
-  }
+@functools.lru_cache(maxsize=None)
+def _hf_reverse_mapping(layer_idx: int = -1, expert_idx: int = -1) -> dict:
+  return {hf_key: key for key, hf_key in _hf_mapping(layer_idx, expert_idx).items()}
+
+
+_HF_TO_MAXTEXT_KEYS = {
+    "model.embed_tokens.weight": "tok_embeddings.weight",
+    "model.norm.weight": "norm.weight",
+    "lm_head.weight": "output.weight",
+}
+
+# suffixes of the per layer Huggingface keys, i.e. what follows `model.layers.{layer_idx}.`
+_HF_TO_MAXTEXT_LAYER_SUFFIXES = {
+    "input_layernorm.weight": "attention_norm.weight",
+    "post_attention_layernorm.weight": "ffn_norm.weight",
+    "self_attn.q_proj.weight": "attention.wq.weight",
+    "self_attn.k_proj.weight": "attention.wk.weight",
+    "self_attn.v_proj.weight": "attention.wv.weight",
+    "self_attn.o_proj.weight": "attention.wo.weight",
+    "self_attn.rotary_emb.inv_freq": "attention.rotary_emb.inv_freq",
+    # MOE model
+    "block_sparse_moe.gate.weight": "feed_forward.gate.weight",
+    # dense model
+    "mlp.gate_proj.weight": "feed_forward.w1.weight",
+    "mlp.down_proj.weight": "feed_forward.w2.weight",
+    "mlp.up_proj.weight": "feed_forward.w3.weight",
+}
+
+_HF_LAYER_KEY_RE = re.compile(r"model\.layers\.(\d+)\.(.+)")
+_HF_EXPERT_SUFFIX_RE = re.compile(r"block_sparse_moe\.experts\.(\d+)\.(w[1-3]\.weight)")
+
+
+def _hf_to_maxtext_key(key: str) -> str:
+  """Rewrites a Huggingface weight name into the Mistral/Llama one used by the converters."""
+  match = _HF_LAYER_KEY_RE.fullmatch(key)
+  if match is None:
+    return _HF_TO_MAXTEXT_KEYS[key]
+  layer_idx, suffix = match.groups()
+  expert_match = _HF_EXPERT_SUFFIX_RE.fullmatch(suffix)
+  if expert_match is not None:
+    return f"layers.{layer_idx}.feed_forward.experts.{expert_match[1]}.{expert_match[2]}"
+  return f"layers.{layer_idx}.{_HF_TO_MAXTEXT_LAYER_SUFFIXES[suffix]}"
+
+
+# numpy dtypes of the safetensors dtype names
+_SAFETENSORS_DTYPES = {
+    "BF16": np.dtype(jnp.bfloat16),
+    "F16": np.dtype(np.float16),
+    "F32": np.dtype(np.float32),
+    "F64": np.dtype(np.float64),
+}
+
+
+@dataclass(frozen=True)
+class _SafetensorsTensor:
+  """A tensor stored in a memory mapped safetensors shard."""
+
+  buffer: np.memmap
+  dtype: np.dtype
+  shape: tuple
+  begin: int
+  end: int
+
+  def read(self):
+    """Returns the tensor as SAVE_DTYPE, as a view into the shard when it is stored in that dtype."""
+    arr = self.buffer[self.begin : self.end].view(self.dtype).reshape(self.shape)
+    return arr if arr.dtype == SAVE_DTYPE else arr.astype(SAVE_DTYPE)
+
+
+def _index_safetensors(ckpt_paths):
+  """Maps every MaxText key to where its tensor is stored in the safetensors shards.
+
+  Only the JSON headers are parsed and the shards are memory mapped, so a tensor is not read from disk
+  until it is used, and then without a copy.
+  """
+  index = {}
+  for i, ckpt_path in enumerate(ckpt_paths):
+    max_logging.log(f"Indexing checkpoint {i+1} of {len(ckpt_paths)} ...")
+    # a shard is a little endian u64 header size, the JSON header, then the tensor data
+    with open(ckpt_path, "rb") as f:
+      (header_size,) = struct.unpack("<Q", f.read(8))
+      header = json.loads(f.read(header_size))
+    header.pop("__metadata__", None)
+    # copy on write rather than read only, so views of it can be wrapped by torch.from_numpy; it is never written
+    buffer = np.memmap(ckpt_path, dtype=np.uint8, mode="c")
+    data_start = 8 + header_size
+    for key, info in header.items():
+      if info["dtype"] not in _SAFETENSORS_DTYPES:
+        raise ValueError(f"Unsupported dtype {info['dtype']} of `{key}` in {ckpt_path}.")
+      begin, end = info["data_offsets"]
+      index[_hf_to_maxtext_key(key)] = _SafetensorsTensor(
+          buffer, _SAFETENSORS_DTYPES[info["dtype"]], tuple(info["shape"]), data_start + begin, data_start + end
+      )
+  return index
+
+
+def _load_safetensors(index, keys):
+  """Returns the tensors for the given MaxText keys as SAVE_DTYPE numpy arrays."""
+  return {key: index[key].read() for key in keys}
+
+
+class _LazySafetensors(Mapping):
+  """A read-only mapping over a safetensors file that only loads a tensor when it is accessed."""
+
+  def __init__(self, path):
+    # kept open until closed, so the header is parsed and the file mapped only once
+    self._file = safe_open(path, framework="pt", device="cpu")
+    self._keys = dict.fromkeys(self._file.keys())
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc_info):
+    self.close()
+
+  def close(self):
+    """Closes the file, the tensors already read from it stay valid."""
+    self._file.__exit__(None, None, None)
+
+  def __getitem__(self, key):
+    if key not in self._keys:
+      raise KeyError(key)
+    return self._file.get_tensor(key)
+
+  def __iter__(self):
+    return iter(self._keys)
+
+  def __len__(self):
+    return len(self._keys)
 
 
 @dataclass
@@ -220,26 +350,70 @@ class _HFNamespaceMapper:
   """
 
   collection: dict
-  delimiter: str = "."
+  # the collection key of every Mistral/Llama weight name, computed once so lookups are plain dict gets
+  _keys: dict = field(init=False, repr=False)
+
+  def __post_init__(self):
+    self._keys = {}
+    for key in self.collection:
+      match = _LAYER_EXPERT_RE.search(key)
+      if match is None:
+        mapping = _hf_reverse_mapping()
+      else:
+        layer_idx, expert_idx = match.groups()
+        mapping = _hf_reverse_mapping(int(layer_idx), -1 if expert_idx is None else int(expert_idx))
+      if key in mapping:
+        self._keys[mapping[key]] = key
+    # original keys take precedence
+    self._keys.update((key, key) for key in self.collection)
 
   def __getitem__(self, key):
-    if key in self.collection:
-      return self.collection[key]  # original key takes precedence
-    fields = key.split(self.delimiter)
-    num_fields = [int(field) for field in fields if re.match(r"[0-9]+", field) is not None]
-    mapping = _hf_mapping(*num_fields)
-    if key not in mapping:
+    return self.collection[self._resolve(key)]
+
+  def pop(self, key):
+    """Removes a weight from the collection, so it can be freed as soon as it has been consumed."""
+    new_key = self._resolve(key)
+    del self._keys[key]
+    return self.collection.pop(new_key)
+
+  def _resolve(self, key):
+    if key not in self._keys:
       raise ValueError(f"Key `{key}` is missing from the original collection and from the mapping.")
-    new_key = mapping[key]
-    if new_key not in self.collection:
-      raise ValueError(f"New key `{new_key}` mapped from `{key}` is missing from the collection.")
-    return self.collection[new_key]
+    return self._keys[key]
+
+
+# torch dtypes of the numpy dtypes converted to by _as_np, bfloat16 is handled separately
+_TORCH_DTYPES = {
+    np.dtype(np.float16): torch.float16,
+    np.dtype(np.float32): torch.float32,
+}
+
+
+def _as_np(tensor, dtype=SAVE_DTYPE):
+  """Converts a torch tensor to a numpy array of dtype, without a copy if it is already stored in that dtype."""
+  if np.dtype(dtype) == np.dtype(jnp.bfloat16):
+    # numpy has no native bfloat16, so reinterpret the raw bits
+    return tensor.to(torch.bfloat16).view(torch.uint16).numpy().view(dtype)
+  return tensor.to(_TORCH_DTYPES[np.dtype(dtype)]).numpy()
+
 
+def _as_torch(arr):
+  """Views a numpy array, bfloat16 included, as a torch tensor sharing its memory and strides."""
+  if arr.dtype == np.dtype(jnp.bfloat16):
+    return torch.from_numpy(arr.view(np.uint16)).view(torch.bfloat16)
+  return torch.from_numpy(arr)
 
-def permute_to_match_maxtext_rope(arr):
-  evens = arr[..., ::2]
-  odds = arr[..., 1::2]
-  return np.concatenate((evens, odds), axis=arr.ndim - 1)
+
+def _copy_into(dest, src, scale=None):
+  """Copies src, optionally scaled, into dest.
+
+  The copy runs on torch's kernels, which do the transposed reads of the conversion several times faster than
+  numpy and release the GIL. A scale is applied in float32 before rounding to the dtype of dest.
+  """
+  if scale is None:
+    _as_torch(dest).copy_(_as_torch(src))
+  else:
+    torch.mul(_as_torch(src), float(scale), out=_as_torch(dest))
 
 
 # pylint: disable=too-many-positional-arguments
@@ -257,20 +431,25 @@ def initialize_self_attention_lora_kernels(
 ):
   """Helper function to intialize LoRA kernels for given target module."""
 
-  lora_A = lora_chkpt_vars[f"{key_prefix}.lora_A.weights"].type(torch.float16).numpy().transpose()
-  lora_B = lora_chkpt_vars[f"{key_prefix}.lora_B.weights"].type(torch.float16).numpy().transpose()
+  lora_A = _as_np(lora_chkpt_vars[f"{key_prefix}.lora_A.weights"], np.float16).transpose()
+  lora_B = _as_np(lora_chkpt_vars[f"{key_prefix}.lora_B.weights"], np.float16).transpose()
 
   if reshape_a:
     lora_A = np.reshape(lora_A, shape_a)
   if reshape_b:
     lora_B = np.reshape(lora_B, shape_b)
 
+  # allocated with the layers stacked on axis 1, the final layout, so no transpose is needed once all are written
   if self_attention_lora[module_name]["lora_a.kernel"] is None:
-    self_attention_lora[module_name]["lora_a.kernel"] = np.zeros(stack_shape + lora_A.shape, dtype=np.float16)
-    self_attention_lora[module_name]["lora_b.kernel"] = np.zeros(stack_shape + lora_B.shape, dtype=np.float16)
+    self_attention_lora[module_name]["lora_a.kernel"] = np.empty(
+        lora_A.shape[:1] + stack_shape + lora_A.shape[1:], dtype=np.float16
+    )
+    self_attention_lora[module_name]["lora_b.kernel"] = np.empty(
+        lora_B.shape[:1] + stack_shape + lora_B.shape[1:], dtype=np.float16
+    )
 
-  self_attention_lora[module_name]["lora_a.kernel"][layer_idx, ...] = lora_A  # pylint: disable=E1137
-  self_attention_lora[module_name]["lora_b.kernel"][layer_idx, ...] = lora_B  # pylint: disable=E1137
+  self_attention_lora[module_name]["lora_a.kernel"][:, layer_idx, ...] = lora_A  # pylint: disable=E1137
+  self_attention_lora[module_name]["lora_b.kernel"][:, layer_idx, ...] = lora_B  # pylint: disable=E1137
 
 
 def convert_lora_weights_to_jax_weights(lora_config, model_size):
@@ -289,10 +468,8 @@ def convert_lora_weights_to_jax_weights(lora_config, model_size):
   mem_info = psutil.Process()
   logging.debug("Memory usage: %f GB", mem_info.memory_info().rss / (1024**3))
 
-  max_logging.log(f"Loading the lora  model from {lora_config['lora_model_path']}")
-  # Load LoRA model weights
-  lora_chkpt_vars = torch.load(lora_config["lora_model_path"])
-  lora_chkpt_vars = _HFNamespaceMapper(lora_chkpt_vars)
+  lora_weights_path = lora_config["lora_model_path"]
+  max_logging.log(f"Loading the lora  model from {lora_weights_path}")
 
   jax_weights_lora = {
       "decoder": {
@@ -345,120 +522,301 @@ def convert_lora_weights_to_jax_weights(lora_config, model_size):
   lora_rank = int(lora_config["r"])
   stack_shape = (base_num_decoder_layers,)
 
-  for layer_idx in range(base_num_decoder_layers):
-    for target_module in lora_target_modules:
-      if "q_proj" in target_module:
-        initialize_self_attention_lora_kernels(
-            self_attention_lora=self_attention_lora,
-            lora_chkpt_vars=lora_chkpt_vars,
-            key_prefix=f"layers.{layer_idx}.attention.wq",
-            stack_shape=stack_shape,
-            reshape_b=True,
-            shape_b=[lora_rank, base_num_query_heads, head_dim],
-            layer_idx=layer_idx,
-            module_name="query",
-        )
+  # Load LoRA model weights lazily, tensors are only read when a layer picks them out
+  if lora_weights_path.endswith(".safetensors"):
+    lora_file = _LazySafetensors(lora_weights_path)
+  else:
+    lora_file = contextlib.nullcontext(torch.load(lora_weights_path, map_location="cpu", mmap=True, weights_only=True))
+  # the kernels are copies of the adapter tensors, so the file is closed once every layer is written
+  with lora_file as lora_state_dict:
+    lora_chkpt_vars = _HFNamespaceMapper(lora_state_dict)
+    for layer_idx in range(base_num_decoder_layers):
+      for target_module in lora_target_modules:
+        if "q_proj" in target_module:
+          initialize_self_attention_lora_kernels(
+              self_attention_lora=self_attention_lora,
+              lora_chkpt_vars=lora_chkpt_vars,
+              key_prefix=f"layers.{layer_idx}.attention.wq",
+              stack_shape=stack_shape,
+              reshape_b=True,
+              shape_b=[lora_rank, base_num_query_heads, head_dim],
+              layer_idx=layer_idx,
+              module_name="query",
+          )
 
-      if "k_proj" in target_module:
-        initialize_self_attention_lora_kernels(
-            self_attention_lora=self_attention_lora,
-            lora_chkpt_vars=lora_chkpt_vars,
-            key_prefix=f"layers.{layer_idx}.attention.wk",
-            stack_shape=stack_shape,
-            reshape_b=True,
-            shape_b=[lora_rank, base_num_query_heads, head_dim],
-            layer_idx=layer_idx,
-            module_name="key",
-        )
+        if "k_proj" in target_module:
+          initialize_self_attention_lora_kernels(
+              self_attention_lora=self_attention_lora,
+              lora_chkpt_vars=lora_chkpt_vars,
+              key_prefix=f"layers.{layer_idx}.attention.wk",
+              stack_shape=stack_shape,
+              reshape_b=True,
+              shape_b=[lora_rank, base_num_query_heads, head_dim],
+              layer_idx=layer_idx,
+              module_name="key",
+          )
 
-      if "v_proj" in target_module:
-        initialize_self_attention_lora_kernels(
-            self_attention_lora=self_attention_lora,
-            lora_chkpt_vars=lora_chkpt_vars,
-            key_prefix=f"layers.{layer_idx}.attention.wv",
-            stack_shape=stack_shape,
-            reshape_b=True,
-            shape_b=[lora_rank, base_num_query_heads, head_dim],
-            layer_idx=layer_idx,
-            module_name="value",
-        )
+        if "v_proj" in target_module:
+          initialize_self_attention_lora_kernels(
+              self_attention_lora=self_attention_lora,
+              lora_chkpt_vars=lora_chkpt_vars,
+              key_prefix=f"layers.{layer_idx}.attention.wv",
+              stack_shape=stack_shape,
+              reshape_b=True,
+              shape_b=[lora_rank, base_num_query_heads, head_dim],
+              layer_idx=layer_idx,
+              module_name="value",
+          )
 
-      if "o_proj" in target_module:
-        lora_A_o = lora_chkpt_vars[f"layers.{layer_idx}.attention.wo.lora_A.weights"].type(torch.float16).numpy()
-        lora_B_o = lora_chkpt_vars[f"layers.{layer_idx}.attention.wo.lora_B.weights"].type(torch.float16).numpy()
+        if "o_proj" in target_module:
+          lora_A_o = _as_np(lora_chkpt_vars[f"layers.{layer_idx}.attention.wo.lora_A.weights"], np.float16)
+          lora_B_o = _as_np(lora_chkpt_vars[f"layers.{layer_idx}.attention.wo.lora_B.weights"], np.float16)
+
+          # This is for "out" matrix. So we don't transpose it above as well as here
+          # we have to reshape the lora_A_o instead of lora_B_o.
+          lora_A_o = np.reshape(lora_A_o, [lora_rank, base_num_query_heads, head_dim])
+
+          if self_attention_lora["out"]["lora_a.kernel"] is None:
+            # allocated in the final [q, layer, head_dim, rank] and [embed, layer, rank] layouts
+            self_attention_lora["out"]["lora_a.kernel"] = np.empty(
+                (base_num_query_heads, base_num_decoder_layers, head_dim, lora_rank), dtype=np.float16
+            )
+            self_attention_lora["out"]["lora_b.kernel"] = np.empty(
+                (lora_B_o.shape[0], base_num_decoder_layers, lora_rank), dtype=np.float16
+            )
+
+          # rank, base_num_query_heads, head_dim => base_num_query_heads, head_dim, rank
+          self_attention_lora["out"]["lora_a.kernel"][:, layer_idx, ...] = np.transpose(  # pylint: disable=E1137
+              lora_A_o, axes=(1, 2, 0)
+          )
+          self_attention_lora["out"]["lora_b.kernel"][:, layer_idx, ...] = lora_B_o  # pylint: disable=E1137
 
-        # This is for "out" matrix. So we don't transpose it above as well as here
-        # we have to reshape the lora_A_o instead of lora_B_o.
-        lora_A_o = np.reshape(lora_A_o, [lora_rank, base_num_query_heads, head_dim])
+  # Not sure if I need to scale the lora query weights by dividing it by np.sqrt(head_dim). Validate it later.
 
-        if self_attention_lora["out"]["lora_a.kernel"] is None:
-          self_attention_lora["out"]["lora_a.kernel"] = np.zeros(stack_shape + lora_A_o.shape, dtype=np.float16)
-          self_attention_lora["out"]["lora_b.kernel"] = np.zeros(stack_shape + lora_B_o.shape, dtype=np.float16)
+  jax_weights_lora["decoder"]["layers"]["self_attention"] = self_attention_lora
 
-        self_attention_lora["out"]["lora_a.kernel"][layer_idx, ...] = lora_A_o  # pylint: disable=E1137
-        self_attention_lora["out"]["lora_b.kernel"][layer_idx, ...] = lora_B_o  # pylint: disable=E1137# pylint: disable=E1137
+  del lora_file, lora_state_dict, lora_chkpt_vars
+  gc.collect()
 
-  if self_attention_lora["query"]["lora_a.kernel"] is not None:
-    self_attention_lora["query"]["lora_a.kernel"] = np.transpose(
-        self_attention_lora["query"]["lora_a.kernel"], axes=(1, 0, 2)
-    )
-    self_attention_lora["query"]["lora_b.kernel"] = np.transpose(
-        self_attention_lora["query"]["lora_b.kernel"], axes=(1, 0, 2, 3)
-    )
+  logging.debug("Memory usage: %f GB", mem_info.memory_info().rss / (1024**3))
 
-  if self_attention_lora["key"]["lora_a.kernel"] is not None:
-    self_attention_lora["key"]["lora_a.kernel"] = np.transpose(self_attention_lora["key"]["lora_a.kernel"], axes=(1, 0, 2))
-    self_attention_lora["key"]["lora_b.kernel"] = np.transpose(
-        self_attention_lora["key"]["lora_b.kernel"], axes=(1, 0, 2, 3)
-    )
+  return jax_weights_lora
 
-  if self_attention_lora["value"]["lora_a.kernel"] is not None:
-    self_attention_lora["value"]["lora_a.kernel"] = np.transpose(
-        self_attention_lora["value"]["lora_a.kernel"], axes=(1, 0, 2)
-    )
-    self_attention_lora["value"]["lora_b.kernel"] = np.transpose(
-        self_attention_lora["value"]["lora_b.kernel"], axes=(1, 0, 2, 3)
-    )
 
-  if self_attention_lora["out"]["lora_a.kernel"] is not None:
-    self_attention_lora["out"]["lora_a.kernel"] = np.transpose(
-        self_attention_lora["out"]["lora_a.kernel"], axes=(2, 0, 3, 1)
-    )
-    self_attention_lora["out"]["lora_b.kernel"] = np.transpose(self_attention_lora["out"]["lora_b.kernel"], axes=(1, 0, 2))
+@dataclass
+class _StackedWeights:
+  """The decoder layer kernels, each allocated in its final layout with the layers stacked on axis 1."""
+
+  query: np.ndarray  # [embed, layer, q, head_dim]
+  key: np.ndarray  # [embed, layer, kv, head_dim]
+  value: np.ndarray  # [embed, layer, kv, head_dim]
+  out: np.ndarray  # [q, layer, head_dim, embed]
+  wi_0: np.ndarray  # [embed, layer, mlp], [experts, layer, embed, mlp] for MoE
+  wi_1: np.ndarray  # [embed, layer, mlp], [experts, layer, embed, mlp] for MoE
+  wo: np.ndarray  # [mlp, layer, embed], [experts, layer, mlp, embed] for MoE
+  gate: Optional[np.ndarray] = None  # [embed, layer, experts], MoE only
+
+  def to_jax_weights(self):
+    """Returns the self attention and mlp (or MoeBlock_0) entries of jax_weights["decoder"]["layers"]."""
+    self_attention = {
+        "query": {"kernel": self.query},
+        "key": {"kernel": self.key},
+        "value": {"kernel": self.value},
+        "out": {"kernel": self.out},
+    }
+    if self.gate is None:
+      mlp = {"wi_0": {"kernel": self.wi_0}, "wi_1": {"kernel": self.wi_1}, "wo": {"kernel": self.wo}}
+      return {"self_attention": self_attention, "mlp": mlp}
+    moe = {"gate": {"kernel": self.gate}, "wi_0": self.wi_0, "wi_1": self.wi_1, "wo": self.wo}
+    return {"self_attention": self_attention, "MoeBlock_0": moe}
 
-  # Not sure if I need to scale the lora query weights by dividing it by np.sqrt(head_dim). Validate it later.
 
-  jax_weights_lora["decoder"]["layers"]["self_attention"] = self_attention_lora
+def _allocate_stacked_weights(model_params, mlp_dim, dtype, mmap_dir=None):
+  """Allocates the stacked kernels with every shape computed up front from model_params and the mlp dim.
 
-  del lora_chkpt_vars
-  gc.collect()
+  They are left uninitialized since every layer slice is overwritten by the conversion. With mmap_dir, the kernels
+  are memory mapped files in that directory instead, so the layers are written through the page cache and the
+  resident memory no longer grows with the model size.
+  """
+  num_layers = model_params["num_layers"]
+  num_query_heads = model_params["num_heads"]
+  num_kv_heads = model_params["num_kv_heads"]
+  head_dim = model_params["dims_per_head"]
+  num_experts = model_params.get("num_experts")
+  embed_dim = num_query_heads * head_dim
 
-  logging.debug("Memory usage: %f GB", mem_info.memory_info().rss / (1024**3))
+  def empty(name, shape):
+    if mmap_dir is None:
+      return np.empty(shape, dtype=dtype)
+    # new files are sparse, so no pages are written until the layers are
+    return np.memmap(os.path.join(mmap_dir, name), mode="w+", dtype=dtype, shape=shape)
 
-  return jax_weights_lora
+  if num_experts is None:
+    mlp_shapes = {"wi_0": (embed_dim, num_layers, mlp_dim), "wo": (mlp_dim, num_layers, embed_dim)}
+    gate = None
+  else:
+    mlp_shapes = {"wi_0": (num_experts, num_layers, embed_dim, mlp_dim), "wo": (num_experts, num_layers, mlp_dim, embed_dim)}
+    gate = empty("gate", (embed_dim, num_layers, num_experts))
+  return _StackedWeights(
+      query=empty("query", (embed_dim, num_layers, num_query_heads, head_dim)),
+      key=empty("key", (embed_dim, num_layers, num_kv_heads, head_dim)),
+      value=empty("value", (embed_dim, num_layers, num_kv_heads, head_dim)),
+      out=empty("out", (num_query_heads, num_layers, head_dim, embed_dim)),
+      wi_0=empty("wi_0", mlp_shapes["wi_0"]),
+      wi_1=empty("wi_1", mlp_shapes["wi_0"]),
+      wo=empty("wo", mlp_shapes["wo"]),
+      gate=gate,
+  )
+
+
+def _write_shards(dest, shards, axis, scale=None):
+  """Writes the shards of a weight, split along axis and optionally scaled, into consecutive slices of dest."""
+  start = 0
+  for shard in shards:
+    end = start + shard.shape[axis]
+    _copy_into(dest[(slice(None),) * axis + (slice(start, end),)], shard, scale)
+    start = end
+  # dest is uninitialized, so shards that don't cover it would leave garbage behind
+  if start != dest.shape[axis]:
+    raise ValueError(f"Checkpoint shards cover {start} of the {dest.shape[axis]} entries along axis {axis}")
+
+
+def _concatenate_shards(shards, axis):
+  """np.concatenate of the shards of a weight, written straight into a preallocated array by _write_shards."""
+  shards = list(shards)
+  if len(shards) == 1:
+    # single shard checkpoints (e.g. the 7b models) need no copy, the shard is returned as is
+    return shards[0]
+  shape = list(shards[0].shape)
+  shape[axis] = sum(shard.shape[axis] for shard in shards)
+  out = np.empty(shape, dtype=shards[0].dtype)
+  _write_shards(out, shards, axis)
+  return out
+
+
+@dataclass(frozen=True)
+class _KernelWrite:
+  """How a [heads * head_dim, embed] projection is copied into its stacked kernel."""
+
+  source_shape: tuple
+  source_axes: tuple
+  dest_shape: tuple
+
+  def _dest(self, stacked_kernel, layer_idx):
+    """The layer slice of stacked_kernel, viewed in the dest_shape the transposed source is copied into."""
+    dest = stacked_kernel[:, layer_idx, ...].reshape(self.dest_shape)
+    # reshape returns a copy rather than a view when it can't split the axes in place, and the write would be lost
+    if not np.may_share_memory(dest, stacked_kernel):
+      raise ValueError(f"The stacked kernel of shape {stacked_kernel.shape} can't be viewed as {self.dest_shape}.")
+    return dest
+
+  def write(self, stacked_kernel, layer_idx, weight, scale=None):
+    """Writes one layer, folding the transpose and the optional scaling into a single copy."""
+    weight = weight.reshape(self.source_shape).transpose(self.source_axes)
+    _copy_into(self._dest(stacked_kernel, layer_idx), weight, scale)
+
+  def write_shards(self, stacked_kernel, layer_idx, weights, scale=None):
+    """Writes one layer of a projection split by heads across checkpoint shards, each into its range of heads."""
+    weights = (weight.reshape(self.source_shape).transpose(self.source_axes) for weight in weights)
+    _write_shards(self._dest(stacked_kernel, layer_idx), weights, axis=1, scale=scale)
+
+
+@dataclass(frozen=True)
+class _LayerShapes:
+  """The static shapes used to write a decoder layer into the stacked kernels."""
+
+  query: _KernelWrite
+  key: _KernelWrite
+  value: _KernelWrite
+  out_shape: tuple  # [embed, q, head_dim]
+
+
+def _kernel_write(head_dim, embed_dim, rope_split=None):
+  """Source and stacked kernel views of a projection write.
+
+  With rope_split, head_dim is read as the two axes of rope_split and written with them swapped, which reorders
+  the rope weights in the same copy. The number of heads is inferred, so a shard holding a range of them works too.
+  """
+  if rope_split is None:
+    return _KernelWrite(source_shape=(-1, head_dim, embed_dim), source_axes=(2, 0, 1), dest_shape=(embed_dim, -1, head_dim))
+  return _KernelWrite(
+      source_shape=(-1, *rope_split, embed_dim),
+      source_axes=(3, 0, 2, 1),
+      dest_shape=(embed_dim, -1, *reversed(rope_split)),
+  )
+
+
+def _layer_shapes(num_heads, head_dim, embed_dim, rope_split=None):
+  """The write plan of the attention kernels of a layer, the rope weights are reordered as described in _kernel_write.
+
+  rope_split is (2, head_dim // 2) to interleave the two halves of head_dim, as max_utils.permute_to_match_maxtext_rope
+  does, or (head_dim // 2, 2) to move its evens before its odds.
+  """
+  return _LayerShapes(
+      query=_kernel_write(head_dim, embed_dim, rope_split),
+      key=_kernel_write(head_dim, embed_dim, rope_split),
+      value=_kernel_write(head_dim, embed_dim),
+      out_shape=(embed_dim, num_heads, head_dim),
+  )
+
+
+def _query_scale(head_dim):
+  """The 1 / sqrt(head_dim) the query kernel is scaled by as it is written, in float32 so it isn't rounded."""
+  return np.float32(1.0 / np.sqrt(head_dim))
 
 
-def _convert_huggingface_to_jax_weights(base_model_path, model_size, model_params, mem_info):
-  """Convert Huggingface Checkpoint to Jax."""
+def _stack_layer_norms(layer_norms):
+  """Stacks the per layer norm scales on the last axis, which is directly their [embed, layer] layout."""
+  return np.stack(layer_norms, axis=1)
+
+
+def _map_layers(fn, num_layers):
+  """Returns [fn(layer_idx) for every layer], run on a thread pool.
+
+  Each layer only writes its own slices of the stacked kernels, and the work is dominated by tensor reads and
+  copies which release the GIL.
+  """
+  num_threads = min(MAX_CONVERSION_THREADS, os.cpu_count() or 1, num_layers)
+  with concurrent.futures.ThreadPoolExecutor(max_workers=num_threads) as executor:
+    return list(tqdm(executor.map(fn, range(num_layers)), total=num_layers, desc="layers", leave=False))
+
+
+def _write_hf_experts(stacked, index, layer_idx, num_experts):
+  """Reads the experts of a MoE layer and writes them, transposed, into the stacked MoE kernels.
+
+  The experts are read concurrently since each one only writes its own slice. Only the experts in flight
+  are paged in rather than the whole layer.
+  """
+
+  def convert_expert(k):
+    for name, w in (("wi_0", "w1"), ("wi_1", "w3"), ("wo", "w2")):
+      weight = index[f"layers.{layer_idx}.feed_forward.experts.{k}.{w}.weight"].read()
+      _copy_into(getattr(stacked, name)[k, layer_idx, ...], weight.T)
+
+  with concurrent.futures.ThreadPoolExecutor(max_workers=min(MAX_EXPERT_THREADS, num_experts)) as executor:
+    list(executor.map(convert_expert, range(num_experts)))
+
+
+def _convert_huggingface_to_jax_weights(
+    base_model_path, model_size, model_params, mem_info, mmap_dir=None, copy_views=False
+):
+  """Convert Huggingface Checkpoint to Jax.
+
+  The decoder norm, logits and token embedding are views of the memory mapped shards unless copy_views is set, in
+  which case they are copied so the shards can be deleted once this returns.
+  """
   base_num_decoder_layers = model_params["num_layers"]
-  base_num_query_heads = model_params["num_heads"]
   head_dim = model_params["dims_per_head"]
-  base_num_kv_heads = model_params["num_kv_heads"]
   vocab_size = model_params["vocab"]
   num_experts = model_params["num_experts"] if "num_experts" in model_params else None
 
   max_logging.log(f"Loading the base model from {base_model_path}")
   ckpt_paths = sorted(pathlib.Path(base_model_path).glob("[!.]*.safetensors"))
-  chkpt_vars = {}
-  for i, ckpt_path in enumerate(ckpt_paths):
-    max_logging.log(f"Loading checkpoint {i+1} of {len(ckpt_paths)} ...")
+  # tensors are read on demand, one layer at a time, instead of materializing the whole checkpoint
+  index = _index_safetensors(ckpt_paths)
 
-    with safe_open(ckpt_path, framework="pt", device="cpu") as f:
-      for key in f.keys():
-        parts = key.split(".")
-        layer = int(parts[2]) if "layers" in key else 0
-        mapped_key = _hf_to_maxtext_mapping(layer)[key]
-        chkpt_vars[mapped_key] = f.get_tensor(key)
+  def own(arr):
+    return np.array(arr) if copy_views else arr
 
   logging.debug("Memory usage: %f GB", mem_info.memory_info().rss / (1024**3))
 
@@ -480,220 +838,139 @@ def _convert_huggingface_to_jax_weights(base_model_path, model_size, model_param
 
   # decoder norm scale ###########################################
   max_logging.log("Processing decoder norm scale")
-  decoder_norm_scale = chkpt_vars["norm.weight"].to(torch.float16).numpy()
-  jax_weights["decoder"]["decoder_norm"]["scale"] = decoder_norm_scale
+  chkpt_vars = _load_safetensors(index, ["norm.weight"])
+  decoder_norm_scale = chkpt_vars["norm.weight"]
+  jax_weights["decoder"]["decoder_norm"]["scale"] = own(decoder_norm_scale)
 
   logging.debug("Memory usage: %f GB", mem_info.memory_info().rss / (1024**3))
 
   # logits dense #################################################
   max_logging.log("Processing logits dense")
+  chkpt_vars = _load_safetensors(index, ["output.weight"])
 
-  jax_weights["decoder"]["logits_dense"]["kernel"] = (
-      chkpt_vars["output.weight"].to(torch.float16).numpy().transpose()[:, :vocab_size]
-  )
+  jax_weights["decoder"]["logits_dense"]["kernel"] = own(chkpt_vars["output.weight"].transpose()[:, :vocab_size])
 
   logging.debug("Memory usage: %f GB", mem_info.memory_info().rss / (1024**3))
 
   # token embedding ##############################################
   max_logging.log("Processing token embeddings")
+  chkpt_vars = _load_safetensors(index, ["tok_embeddings.weight"])
 
   if model_size[:6] == "llama3":
-    jax_weights["token_embedder"]["embedding"] = chkpt_vars["tok_embeddings.weight"].to(torch.float16).numpy()
+    jax_weights["token_embedder"]["embedding"] = own(chkpt_vars["tok_embeddings.weight"])
   else:
-    jax_weights["token_embedder"]["embedding"] = (
-        chkpt_vars["tok_embeddings.weight"].to(torch.float16).numpy()[:vocab_size, :]
-    )
-
-  logging.debug("Memory usage: %f GB", mem_info.memory_info().rss / (1024**3))
-
-  # self attention ###############################################
-  max_logging.log("Processing self attention")
-  self_attention = {
-      "query": {"kernel": None},
-      "key": {"kernel": None},
-      "value": {"kernel": None},
-      "out": {"kernel": None},
-  }
-  for layer_idx in tqdm(range(base_num_decoder_layers), desc="layers", leave=False):
-    wq = chkpt_vars[f"layers.{layer_idx}.attention.wq.weight"].to(torch.float16).numpy().transpose()
-    wk = chkpt_vars[f"layers.{layer_idx}.attention.wk.weight"].to(torch.float16).numpy().transpose()
-    wv = chkpt_vars[f"layers.{layer_idx}.attention.wv.weight"].to(torch.float16).numpy().transpose()
-
-    wq = np.reshape(wq, [base_num_query_heads * head_dim, base_num_query_heads, head_dim])
-    wk = np.reshape(wk, [base_num_query_heads * head_dim, base_num_kv_heads, head_dim])
-    wv = np.reshape(wv, [base_num_query_heads * head_dim, base_num_kv_heads, head_dim])
-
-    if model_size[:8] == "llama3.1":
-      wq = max_utils.permute_to_match_maxtext_rope(wq)
-      wk = max_utils.permute_to_match_maxtext_rope(wk)
-
-    w_post = chkpt_vars[f"layers.{layer_idx}.attention.wo.weight"].to(torch.float16).numpy()
-
-    w_post = np.reshape(w_post, [base_num_query_heads * head_dim, base_num_query_heads, head_dim])
-
-    if self_attention["query"]["kernel"] is None:
-      stack_shape = (base_num_decoder_layers,)
-      self_attention["query"]["kernel"] = np.zeros(stack_shape + wq.shape, dtype=np.float16)
-      self_attention["key"]["kernel"] = np.zeros(stack_shape + wk.shape, dtype=np.float16)
-      self_attention["value"]["kernel"] = np.zeros(stack_shape + wv.shape, dtype=np.float16)
-      self_attention["out"]["kernel"] = np.zeros(stack_shape + w_post.shape, dtype=np.float16)
-
-    self_attention["query"]["kernel"][layer_idx, ...] = wq  # pylint: disable=E1137
-    self_attention["key"]["kernel"][layer_idx, ...] = wk  # pylint: disable=E1137
-    self_attention["value"]["kernel"][layer_idx, ...] = wv  # pylint: disable=E1137
-    self_attention["out"]["kernel"][layer_idx, ...] = w_post  # pylint: disable=E1137
-
-  self_attention["query"]["kernel"] = np.transpose(
-      self_attention["query"]["kernel"], axes=(1, 0, 2, 3)
-  )  # [embed, layer, q, head_dim]
-  self_attention["key"]["kernel"] = np.transpose(
-      self_attention["key"]["kernel"], axes=(1, 0, 2, 3)
-  )  # [embed, layer, kv, head_dim]
-  self_attention["value"]["kernel"] = np.transpose(
-      self_attention["value"]["kernel"], axes=(1, 0, 2, 3)
-  )  # [embed, layer, kv, head_dim]
-  # layers, base_num_query_heads * head_dim, base_num_query_heads, head_dim =>
-  # base_num_query_heads, layers,head_dim, base_num_query_heads * head_dim
-  self_attention["out"]["kernel"] = np.transpose(
-      self_attention["out"]["kernel"], axes=(2, 0, 3, 1)
-  )  # [q, layer, head_dim, embed]
-
-  # scale the query weights
-  self_attention["query"]["kernel"] = self_attention["query"]["kernel"] / np.sqrt(head_dim)
-
-  jax_weights["decoder"]["layers"]["self_attention"] = self_attention
-  logging.debug("Memory usage: %f GB", mem_info.memory_info().rss / (1024**3))
-
-  # layer weight pre and post self attention norm ################
-  max_logging.log("Processing pre and post self attention norms")
-  layer_weight = {"pre_self_attention_layer_norm": {"scale": None}, "post_self_attention_layer_norm": {"scale": None}}
-
-  # self attention layer norm and swap the layer index
-  for layer_idx in tqdm(range(base_num_decoder_layers), desc="layers", leave=False):
-    pre_self_attention_layernorm = chkpt_vars[f"layers.{layer_idx}.attention_norm.weight"].type(torch.float16).numpy()
-    post_self_attention_layernorm = chkpt_vars[f"layers.{layer_idx}.ffn_norm.weight"].type(torch.float16).numpy()
-    if layer_weight["pre_self_attention_layer_norm"]["scale"] is None:
-      stack_shape = (base_num_decoder_layers,)
-      layer_weight["pre_self_attention_layer_norm"]["scale"] = np.zeros(
-          stack_shape + pre_self_attention_layernorm.shape, dtype=np.float16
-      )
-      layer_weight["post_self_attention_layer_norm"]["scale"] = np.zeros(
-          stack_shape + post_self_attention_layernorm.shape, dtype=np.float16
-      )
-    layer_weight["pre_self_attention_layer_norm"]["scale"][layer_idx, ...] = pre_self_attention_layernorm  # pylint: disable=E1137
-    layer_weight["post_self_attention_layer_norm"]["scale"][layer_idx, ...] = post_self_attention_layernorm  # pylint: disable=E1137
-
-  layer_weight["pre_self_attention_layer_norm"]["scale"] = np.transpose(
-      layer_weight["pre_self_attention_layer_norm"]["scale"], axes=(1, 0)
-  )
-  layer_weight["post_self_attention_layer_norm"]["scale"] = np.transpose(
-      layer_weight["post_self_attention_layer_norm"]["scale"], axes=(1, 0)
-  )
+    jax_weights["token_embedder"]["embedding"] = own(chkpt_vars["tok_embeddings.weight"][:vocab_size, :])
 
-  jax_weights["decoder"]["layers"]["pre_self_attention_layer_norm"] = layer_weight["pre_self_attention_layer_norm"]
-  jax_weights["decoder"]["layers"]["post_self_attention_layer_norm"] = layer_weight["post_self_attention_layer_norm"]
+  del chkpt_vars
+  gc.collect()
   logging.debug("Memory usage: %f GB", mem_info.memory_info().rss / (1024**3))
 
-  # layer weights ################################################
-  max_logging.log("Processing layer weights")
+  # layers #######################################################
+  max_logging.log("Processing layers")
+  # every stacked kernel is allocated up front in its final layout, so the layers can be converted
+  # concurrently with each one writing only to its own slice
   if num_experts is None:
-    layer_weight["mlp"] = {
-        "wi_0": {"kernel": None},
-        "wi_1": {"kernel": None},
-        "wo": {"kernel": None},
-    }
+    mlp_dim = index["layers.0.feed_forward.w1.weight"].shape[0]
   else:
-    layer_weight["gate"] = {"kernel": None}
-
-    for k in range(num_experts):
-      jax_weights["decoder"]["layers"]["MoeBlock_0"]["gate"] = {}
-    layer_weight["mlp"] = {
-        "wi_0": {"kernel": None},
-        "wi_1": {"kernel": None},
-        "wo": {"kernel": None},
-    }
+    mlp_dim = index["layers.0.feed_forward.experts.0.w1.weight"].shape[0]
+  stacked = _allocate_stacked_weights(model_params, mlp_dim, SAVE_DTYPE, mmap_dir)
+  # the Huggingface llama3.1 rope weights have the two halves of head_dim interleaved
+  rope_split = (2, head_dim // 2) if model_size[:8] == "llama3.1" else None
+  shapes = _layer_shapes(model_params["num_heads"], head_dim, model_params["num_heads"] * head_dim, rope_split)
+  query_scale = _query_scale(head_dim)
+
+  def convert_layer(layer_idx):
+    """Writes the kernels of a layer into the stacked kernels and returns its (tiny) pre and post norms."""
+    # self attention
+    chkpt_vars = _load_safetensors(index, [f"layers.{layer_idx}.attention.{w}.weight" for w in ("wq", "wk", "wv", "wo")])
+    wq = chkpt_vars[f"layers.{layer_idx}.attention.wq.weight"]
+    wk = chkpt_vars[f"layers.{layer_idx}.attention.wk.weight"]
+    wv = chkpt_vars[f"layers.{layer_idx}.attention.wv.weight"]
+
+    shapes.query.write(stacked.query, layer_idx, wq, query_scale)
+    shapes.key.write(stacked.key, layer_idx, wk)
+    shapes.value.write(stacked.value, layer_idx, wv)
+
+    w_post = chkpt_vars[f"layers.{layer_idx}.attention.wo.weight"].reshape(shapes.out_shape)
+
+    # embed, base_num_query_heads, head_dim => base_num_query_heads, head_dim, embed
+    _copy_into(stacked.out[:, layer_idx, ...], np.transpose(w_post, axes=(1, 2, 0)))
+    del chkpt_vars, wq, wk, wv, w_post
+
+    # pre and post self attention norm
+    chkpt_vars = _load_safetensors(
+        index, [f"layers.{layer_idx}.attention_norm.weight", f"layers.{layer_idx}.ffn_norm.weight"]
+    )
+    pre_self_attention_layernorm = chkpt_vars[f"layers.{layer_idx}.attention_norm.weight"]
+    post_self_attention_layernorm = chkpt_vars[f"layers.{layer_idx}.ffn_norm.weight"]
+    del chkpt_vars
 
-  for layer_idx in tqdm(range(base_num_decoder_layers), desc="layers", leave=False):
+    # mlp
     if num_experts is None:
-      wi_0 = chkpt_vars[f"layers.{layer_idx}.feed_forward.w1.weight"].type(torch.float16).numpy().transpose()
-      wi_1 = chkpt_vars[f"layers.{layer_idx}.feed_forward.w3.weight"].type(torch.float16).numpy().transpose()
-      wo = chkpt_vars[f"layers.{layer_idx}.feed_forward.w2.weight"].type(torch.float16).numpy().transpose()
-
-      if layer_weight["mlp"]["wi_0"]["kernel"] is None:
-        stack_shape = (base_num_decoder_layers,)
-        layer_weight["mlp"]["wi_0"]["kernel"] = np.zeros(stack_shape + wi_0.shape, dtype=np.float16)
-        layer_weight["mlp"]["wi_1"]["kernel"] = np.zeros(stack_shape + wi_1.shape, dtype=np.float16)
-        layer_weight["mlp"]["wo"]["kernel"] = np.zeros(stack_shape + wo.shape, dtype=np.float16)
-      layer_weight["mlp"]["wi_0"]["kernel"][layer_idx, ...] = wi_0  # pytype: disable=unsupported-operands
-      layer_weight["mlp"]["wi_1"]["kernel"][layer_idx, ...] = wi_1  # pytype: disable=unsupported-operands
-      layer_weight["mlp"]["wo"]["kernel"][layer_idx, ...] = wo  # pytype: disable=unsupported-operands
+      chkpt_vars = _load_safetensors(index, [f"layers.{layer_idx}.feed_forward.{w}.weight" for w in ("w1", "w2", "w3")])
+      wi_0 = chkpt_vars[f"layers.{layer_idx}.feed_forward.w1.weight"].transpose()
+      wi_1 = chkpt_vars[f"layers.{layer_idx}.feed_forward.w3.weight"].transpose()
+      wo = chkpt_vars[f"layers.{layer_idx}.feed_forward.w2.weight"].transpose()
+
+      _copy_into(stacked.wi_0[:, layer_idx, ...], wi_0)
+      _copy_into(stacked.wi_1[:, layer_idx, ...], wi_1)
+      _copy_into(stacked.wo[:, layer_idx, ...], wo)
     else:
-      gate = np.concatenate(
-          [var[f"layers.{layer_idx}.feed_forward.gate.weight"].type(torch.float16).numpy() for var in chkpt_vars], axis=0
-      ).transpose()
-      if layer_weight["gate"]["kernel"] is None:
-        stack_shape = (base_num_decoder_layers,)
-        layer_weight["gate"]["kernel"] = np.zeros(stack_shape + gate.shape, dtype=np.float16)
-      layer_weight["gate"]["kernel"][layer_idx, ...] = gate
-      for k in tqdm(range(num_experts), desc="experts", leave=False):
-        wi_0 = chkpt_vars[f"layers.{layer_idx}.feed_forward.experts.{k}.w1.weight"].type(torch.float16).numpy().transpose()
-        wi_1 = chkpt_vars[f"layers.{layer_idx}.feed_forward.experts.{k}.w3.weight"].type(torch.float16).numpy().transpose()
-        wo = chkpt_vars[f"layers.{layer_idx}.feed_forward.experts.{k}.w2.weight"].type(torch.float16).numpy().transpose()
-
-        if layer_weight["mlp"]["wi_0"]["kernel"] is None:
-          stack_shape = (num_experts, base_num_decoder_layers)
-          layer_weight["mlp"]["wi_0"]["kernel"] = np.zeros(stack_shape + wi_0.shape, dtype=np.float16)
-          layer_weight["mlp"]["wi_1"]["kernel"] = np.zeros(stack_shape + wi_1.shape, dtype=np.float16)
-          layer_weight["mlp"]["wo"]["kernel"] = np.zeros(stack_shape + wo.shape, dtype=np.float16)
-        ei, li = k, layer_idx
-        layer_weight["mlp"]["wi_0"]["kernel"][ei, li, ...] = wi_0
-        layer_weight["mlp"]["wi_1"]["kernel"][ei, li, ...] = wi_1
-        layer_weight["mlp"]["wo"]["kernel"][ei, li, ...] = wo
-      gc.collect()
-  logging.debug("Memory usage: %f GB", mem_info.memory_info().rss / (1024**3))
-
-  if num_experts is None:
-    # swap the layer index
-    layer_weight["mlp"]["wi_0"]["kernel"] = np.transpose(layer_weight["mlp"]["wi_0"]["kernel"], axes=(1, 0, 2))
-    layer_weight["mlp"]["wi_1"]["kernel"] = np.transpose(layer_weight["mlp"]["wi_1"]["kernel"], axes=(1, 0, 2))
-    layer_weight["mlp"]["wo"]["kernel"] = np.transpose(layer_weight["mlp"]["wo"]["kernel"], axes=(1, 0, 2))
+      chkpt_vars = _load_safetensors(index, [f"layers.{layer_idx}.feed_forward.gate.weight"])
+      # [num_experts, embed] => [embed, num_experts]
+      _copy_into(stacked.gate[:, layer_idx, ...], chkpt_vars[f"layers.{layer_idx}.feed_forward.gate.weight"].T)
+      _write_hf_experts(stacked, index, layer_idx, num_experts)
+    del chkpt_vars
+    return pre_self_attention_layernorm, post_self_attention_layernorm
+
+  layer_norms = _map_layers(convert_layer, base_num_decoder_layers)
+  gc.collect()
 
-    jax_weights["decoder"]["layers"]["mlp"] = layer_weight["mlp"]
-  else:
-    layer_weight["gate"]["kernel"] = np.transpose(layer_weight["gate"]["kernel"], axes=(1, 0, 2))
-    jax_weights["decoder"]["layers"]["MoeBlock_0"]["gate"]["kernel"] = layer_weight["gate"]["kernel"]
+  jax_weights["decoder"]["layers"].update(stacked.to_jax_weights())
 
-    jax_weights["decoder"]["layers"]["MoeBlock_0"]["wi_0"] = layer_weight["mlp"]["wi_0"]["kernel"]
-    jax_weights["decoder"]["layers"]["MoeBlock_0"]["wi_1"] = layer_weight["mlp"]["wi_1"]["kernel"]
-    jax_weights["decoder"]["layers"]["MoeBlock_0"]["wo"] = layer_weight["mlp"]["wo"]["kernel"]
+  pre_self_attention_layernorms, post_self_attention_layernorms = zip(*layer_norms)
+  jax_weights["decoder"]["layers"]["pre_self_attention_layer_norm"] = {
+      "scale": _stack_layer_norms(pre_self_attention_layernorms)
+  }
+  jax_weights["decoder"]["layers"]["post_self_attention_layer_norm"] = {
+      "scale": _stack_layer_norms(post_self_attention_layernorms)
+  }
+  del layer_norms, pre_self_attention_layernorms, post_self_attention_layernorms
   logging.debug("Memory usage: %f GB", mem_info.memory_info().rss / (1024**3))
 
-  del chkpt_vars
-  gc.collect()
-  logging.debug("Memory usage: %f GB", mem_info.memory_info().rss / (1024**3))
   return jax_weights
 
 
-def _convert_pytorch_to_jax_weights(base_model_path, model_size, model_params, mem_info):
+def _convert_pytorch_to_jax_weights(base_model_path, model_size, model_params, mem_info, mmap_dir=None, device_count=None):
   """Convert Pytorch Checkpoint To Jax Weights."""
   base_num_decoder_layers = model_params["num_layers"]
   base_num_query_heads = model_params["num_heads"]
   head_dim = model_params["dims_per_head"]
-  base_num_kv_heads = model_params["num_kv_heads"]
   vocab_size = model_params["vocab"]
   num_experts = model_params["num_experts"] if "num_experts" in model_params else None
 
-  chkpt_vars = {}
   ckpt_paths = sorted(pathlib.Path(base_model_path).glob("[!.]*.pth"))
-  for i, ckpt_path in enumerate(ckpt_paths):
-    max_logging.log(f"Loading checkpoint {i+1} of {len(ckpt_paths)} ...")
-    chkpt_vars[int(ckpt_path.name.split(".", maxsplit=2)[1])] = torch.load(ckpt_path, map_location="cpu")
+  max_logging.log(f"Loading {len(ckpt_paths)} checkpoint shards ...")
+
+  def load_shard(ckpt_path):
+    # memory mapped, so the tensors are paged in from the page cache as they are read rather than all up front
+    return torch.load(ckpt_path, map_location="cpu", mmap=True, weights_only=True)
+
+  num_threads = min(MAX_CONVERSION_THREADS, os.cpu_count() or 1, len(ckpt_paths))
+  with concurrent.futures.ThreadPoolExecutor(max_workers=num_threads) as executor:
+    shards = executor.map(load_shard, ckpt_paths)
+    chkpt_vars = {int(ckpt_path.name.split(".", maxsplit=2)[1]): shard for ckpt_path, shard in zip(ckpt_paths, shards)}
   chkpt_vars = [chkpt_vars[i] for i in sorted(list(chkpt_vars.keys()))]
   # map weight names if they use HuggingFace instead of PyTorch convention
   chkpt_vars = [_HFNamespaceMapper(var) for var in chkpt_vars]
 
   logging.debug("Memory usage: %f GB", mem_info.memory_info().rss / (1024**3))
 
+  def finish(arr):
+    # with device_count, each finished weight is put on the devices right away so its host buffer is released
+    # before the next one is built, rather than all of them being held until save_weights_to_checkpoint
+    return arr if device_count is None else checkpoint_device_put(arr, device_count)
+
   # initialize the data structure for storing jax_weights
   layer_key = "MoeBlock_0" if num_experts else "mlp"
   jax_weights = {
@@ -712,221 +989,137 @@ def _convert_pytorch_to_jax_weights(base_model_path, model_size, model_params, m
 
   # decoder norm scale ###########################################
   max_logging.log("Processing decoder norm scale")
-  decoder_norm_scale = chkpt_vars[0]["norm.weight"].type(torch.float16).numpy()
-  jax_weights["decoder"]["decoder_norm"]["scale"] = decoder_norm_scale
+  decoder_norm_scale = _as_np(chkpt_vars[0]["norm.weight"])
+  jax_weights["decoder"]["decoder_norm"]["scale"] = finish(decoder_norm_scale)
+  # every shard holds a replica of the norms
+  for var in chkpt_vars:
+    var.pop("norm.weight")
 
   logging.debug("Memory usage: %f GB", mem_info.memory_info().rss / (1024**3))
 
   # logits dense #################################################
   max_logging.log("Processing logits dense")
-  logits_dense = np.concatenate(
-      [var["output.weight"].type(torch.float16).numpy() for var in chkpt_vars], axis=0
-  ).transpose()[:, :vocab_size]
-  jax_weights["decoder"]["logits_dense"]["kernel"] = logits_dense
+  # [vocab, embed] shards => [embed, vocab], transposed as the shards are copied in
+  logits_dense = _concatenate_shards((_as_np(var.pop("output.weight")).T for var in chkpt_vars), axis=1)
+  jax_weights["decoder"]["logits_dense"]["kernel"] = finish(logits_dense[:, :vocab_size])
+  del logits_dense
 
   logging.debug("Memory usage: %f GB", mem_info.memory_info().rss / (1024**3))
 
   # token embedding ##############################################
   max_logging.log("Processing token embeddings")
   if model_size[:6] == "llama3":
-    token_embedder = np.concatenate([var["tok_embeddings.weight"].type(torch.float16).numpy() for var in chkpt_vars], axis=0)
+    token_embedder = _concatenate_shards((_as_np(var.pop("tok_embeddings.weight")) for var in chkpt_vars), axis=0)
   else:
-    token_embedder = np.concatenate(
-        [var["tok_embeddings.weight"].type(torch.float16).numpy() for var in chkpt_vars], axis=1
-    )[:vocab_size, :]
-  jax_weights["token_embedder"]["embedding"] = token_embedder
+    token_embedder = _concatenate_shards((_as_np(var.pop("tok_embeddings.weight")) for var in chkpt_vars), axis=1)
+    token_embedder = token_embedder[:vocab_size, :]
+  jax_weights["token_embedder"]["embedding"] = finish(token_embedder)
+  del token_embedder
   logging.debug("Memory usage: %f GB", mem_info.memory_info().rss / (1024**3))
 
   # self attention ###############################################
   max_logging.log("Processing self attention")
-  self_attention = {
-      "query": {"kernel": None},
-      "key": {"kernel": None},
-      "value": {"kernel": None},
-      "out": {"kernel": None},
-  }
+  # the stacked kernels are allocated in their final layout so each layer is written in place
+  embed_dim = base_num_query_heads * head_dim
+  # the feed forward weights are sharded along the mlp dim
+  w1_key = "layers.0.feed_forward.w1.weight" if num_experts is None else "layers.0.feed_forward.experts.0.w1.weight"
+  mlp_dim = sum(var[w1_key].shape[0] for var in chkpt_vars)
+  stacked = _allocate_stacked_weights(model_params, mlp_dim, SAVE_DTYPE, mmap_dir)
+  query_scale = _query_scale(head_dim)
 
   # llama3.1-405b kv weight is replicated within every two files.
   wkv_step = 1 if model_size != "llama3.1-405b" else 2
-
-  for layer_idx in tqdm(range(base_num_decoder_layers), desc="layers", leave=False):
-    wq = np.concatenate(
-        [var[f"layers.{layer_idx}.attention.wq.weight"].type(torch.float16).numpy() for var in chkpt_vars], axis=0
-    ).transpose()
-    wk = np.concatenate(
-        [var[f"layers.{layer_idx}.attention.wk.weight"].type(torch.float16).numpy() for var in chkpt_vars[::wkv_step]],
-        axis=0,
-    ).transpose()
-    wv = np.concatenate(
-        [var[f"layers.{layer_idx}.attention.wv.weight"].type(torch.float16).numpy() for var in chkpt_vars[::wkv_step]],
+  kv_chkpt_vars = chkpt_vars[::wkv_step]
+
+  # each shard holds a range of heads, written straight into its slice of the stacked kernels; the rope weights of
+  # the Meta checkpoints other than llama3 have the evens of head_dim moved before the odds
+  rope_split = (head_dim // 2, 2) if model_size[:8] not in llama3_variants else None
+  shapes = _layer_shapes(base_num_query_heads, head_dim, embed_dim, rope_split)
+
+  def convert_attention(layer_idx):
+    shapes.query.write_shards(
+        stacked.query,
+        layer_idx,
+        (_as_np(var[f"layers.{layer_idx}.attention.wq.weight"]) for var in chkpt_vars),
+        query_scale,
+    )
+    shapes.key.write_shards(
+        stacked.key, layer_idx, (_as_np(var[f"layers.{layer_idx}.attention.wk.weight"]) for var in kv_chkpt_vars)
+    )
+    shapes.value.write_shards(
+        stacked.value, layer_idx, (_as_np(var[f"layers.{layer_idx}.attention.wv.weight"]) for var in kv_chkpt_vars)
+    )
+    # embed, heads * head_dim => heads, head_dim, embed
+    _write_shards(
+        stacked.out[:, layer_idx, ...],
+        (
+            _as_np(var[f"layers.{layer_idx}.attention.wo.weight"]).reshape(embed_dim, -1, head_dim).transpose(1, 2, 0)
+            for var in chkpt_vars
+        ),
         axis=0,
-    ).transpose()
-
-    wq = np.reshape(wq, [base_num_query_heads * head_dim, base_num_query_heads, head_dim])
-    wk = np.reshape(wk, [base_num_query_heads * head_dim, base_num_kv_heads, head_dim])
-    wv = np.reshape(wv, [base_num_query_heads * head_dim, base_num_kv_heads, head_dim])
-
-    if model_size[:8] not in llama3_variants:
-      wq = permute_to_match_maxtext_rope(wq)
-      wk = permute_to_match_maxtext_rope(wk)
-
-    w_post = np.concatenate(
-        [var[f"layers.{layer_idx}.attention.wo.weight"].type(torch.float16).numpy() for var in chkpt_vars],
-        axis=1,
     )
 
-    w_post = np.reshape(w_post, [base_num_query_heads * head_dim, base_num_query_heads, head_dim])
-
-    if self_attention["query"]["kernel"] is None:
-      stack_shape = (base_num_decoder_layers,)
-      self_attention["query"]["kernel"] = np.zeros(stack_shape + wq.shape, dtype=np.float16)
-      self_attention["key"]["kernel"] = np.zeros(stack_shape + wk.shape, dtype=np.float16)
-      self_attention["value"]["kernel"] = np.zeros(stack_shape + wv.shape, dtype=np.float16)
-      self_attention["out"]["kernel"] = np.zeros(stack_shape + w_post.shape, dtype=np.float16)
-
-    self_attention["query"]["kernel"][layer_idx, ...] = wq  # pylint: disable=E1137
-    self_attention["key"]["kernel"][layer_idx, ...] = wk  # pylint: disable=E1137
-    self_attention["value"]["kernel"][layer_idx, ...] = wv  # pylint: disable=E1137
-    self_attention["out"]["kernel"][layer_idx, ...] = w_post  # pylint: disable=E1137
+    # release the consumed weights, including the replicated kv weights skipped above
+    for var in chkpt_vars:
+      for w in ("wq", "wk", "wv", "wo"):
+        var.pop(f"layers.{layer_idx}.attention.{w}.weight")
 
-  self_attention["query"]["kernel"] = np.transpose(self_attention["query"]["kernel"], axes=(1, 0, 2, 3))
-  self_attention["key"]["kernel"] = np.transpose(self_attention["key"]["kernel"], axes=(1, 0, 2, 3))
-  self_attention["value"]["kernel"] = np.transpose(self_attention["value"]["kernel"], axes=(1, 0, 2, 3))
-  # layers, base_num_query_heads * head_dim, base_num_query_heads, head_dim =>
-  # base_num_query_heads, layers,head_dim, base_num_query_heads * head_dim
-  self_attention["out"]["kernel"] = np.transpose(self_attention["out"]["kernel"], axes=(2, 0, 3, 1))
+  _map_layers(convert_attention, base_num_decoder_layers)
 
-  # scale the query weights
-  self_attention["query"]["kernel"] = self_attention["query"]["kernel"] / np.sqrt(head_dim)
-
-  jax_weights["decoder"]["layers"]["self_attention"] = self_attention
+  # the attention kernels are complete once every layer is written
+  stacked.query, stacked.key = finish(stacked.query), finish(stacked.key)
+  stacked.value, stacked.out = finish(stacked.value), finish(stacked.out)
+  gc.collect()
   logging.debug("Memory usage: %f GB", mem_info.memory_info().rss / (1024**3))
 
   # layer weight pre and post self attention norm ################
   max_logging.log("Processing pre and post self attention norms")
-  layer_weight = {"pre_self_attention_layer_norm": {"scale": None}, "post_self_attention_layer_norm": {"scale": None}}
-
-  # self attention layer norm and swap the layer index
-  for layer_idx in tqdm(range(base_num_decoder_layers), desc="layers", leave=False):
-    pre_self_attention_layernorm = chkpt_vars[0][f"layers.{layer_idx}.attention_norm.weight"].type(torch.float16).numpy()
-    post_self_attention_layernorm = chkpt_vars[0][f"layers.{layer_idx}.ffn_norm.weight"].type(torch.float16).numpy()
-    if layer_weight["pre_self_attention_layer_norm"]["scale"] is None:
-      stack_shape = (base_num_decoder_layers,)
-      layer_weight["pre_self_attention_layer_norm"]["scale"] = np.zeros(
-          stack_shape + pre_self_attention_layernorm.shape, dtype=np.float16
-      )
-      layer_weight["post_self_attention_layer_norm"]["scale"] = np.zeros(
-          stack_shape + post_self_attention_layernorm.shape, dtype=np.float16
-      )
-    layer_weight["pre_self_attention_layer_norm"]["scale"][layer_idx, ...] = pre_self_attention_layernorm  # pylint: disable=E1137
-    layer_weight["post_self_attention_layer_norm"]["scale"][layer_idx, ...] = post_self_attention_layernorm  # pylint: disable=E1137
-
-  layer_weight["pre_self_attention_layer_norm"]["scale"] = np.transpose(
-      layer_weight["pre_self_attention_layer_norm"]["scale"], axes=(1, 0)
-  )
-  layer_weight["post_self_attention_layer_norm"]["scale"] = np.transpose(
-      layer_weight["post_self_attention_layer_norm"]["scale"], axes=(1, 0)
-  )
-
-  jax_weights["decoder"]["layers"]["pre_self_attention_layer_norm"] = layer_weight["pre_self_attention_layer_norm"]
-  jax_weights["decoder"]["layers"]["post_self_attention_layer_norm"] = layer_weight["post_self_attention_layer_norm"]
+  # the norms are replicated in every shard, so they are read from the first one
+  for name, key in (("pre_self_attention_layer_norm", "attention_norm"), ("post_self_attention_layer_norm", "ffn_norm")):
+    scale = _stack_layer_norms([_as_np(chkpt_vars[0][f"layers.{i}.{key}.weight"]) for i in range(base_num_decoder_layers)])
+    jax_weights["decoder"]["layers"][name] = {"scale": finish(scale)}
+    for var in chkpt_vars:
+      for layer_idx in range(base_num_decoder_layers):
+        var.pop(f"layers.{layer_idx}.{key}.weight")
   logging.debug("Memory usage: %f GB", mem_info.memory_info().rss / (1024**3))
 
   # layer weights ################################################
   max_logging.log("Processing layer weights")
-  if num_experts is None:
-    layer_weight["mlp"] = {
-        "wi_0": {"kernel": None},
-        "wi_1": {"kernel": None},
-        "wo": {"kernel": None},
-    }
-  else:
-    layer_weight["gate"] = {"kernel": None}
-
-    for k in range(num_experts):
-      jax_weights["decoder"]["layers"]["MoeBlock_0"]["gate"] = {}
-    layer_weight["mlp"] = {
-        "wi_0": {"kernel": None},
-        "wi_1": {"kernel": None},
-        "wo": {"kernel": None},
-    }
 
-  for layer_idx in tqdm(range(base_num_decoder_layers), desc="layers", leave=False):
+  def convert_expert(layer_idx, k):
+    prefix = f"layers.{layer_idx}.feed_forward.experts.{k}"
+    for name, w, axis in (("wi_0", "w1", 1), ("wi_1", "w3", 1), ("wo", "w2", 0)):
+      dest = getattr(stacked, name)[k, layer_idx, ...]
+      _write_shards(dest, (_as_np(var.pop(f"{prefix}.{w}.weight")).T for var in chkpt_vars), axis=axis)
+
+  # w1 and w3 are sharded along their rows and w2 along its columns, each shard is written transposed into its
+  # slice of the mlp dim
+  def convert_mlp(layer_idx):
     if num_experts is None:
-      wi_0 = np.concatenate(
-          [var[f"layers.{layer_idx}.feed_forward.w1.weight"].type(torch.float16).numpy() for var in chkpt_vars], axis=0
-      ).transpose()
-      wi_1 = np.concatenate(
-          [var[f"layers.{layer_idx}.feed_forward.w3.weight"].type(torch.float16).numpy() for var in chkpt_vars], axis=0
-      ).transpose()
-      wo = np.concatenate(
-          [var[f"layers.{layer_idx}.feed_forward.w2.weight"].type(torch.float16).numpy() for var in chkpt_vars], axis=1
-      ).transpose()
-      if layer_weight["mlp"]["wi_0"]["kernel"] is None:
-        stack_shape = (base_num_decoder_layers,)
-        layer_weight["mlp"]["wi_0"]["kernel"] = np.zeros(stack_shape + wi_0.shape, dtype=np.float16)
-        layer_weight["mlp"]["wi_1"]["kernel"] = np.zeros(stack_shape + wi_1.shape, dtype=np.float16)
-        layer_weight["mlp"]["wo"]["kernel"] = np.zeros(stack_shape + wo.shape, dtype=np.float16)
-
-      layer_weight["mlp"]["wi_0"]["kernel"][layer_idx, ...] = wi_0  # pytype: disable=unsupported-operands
-      layer_weight["mlp"]["wi_1"]["kernel"][layer_idx, ...] = wi_1  # pytype: disable=unsupported-operands
-      layer_weight["mlp"]["wo"]["kernel"][layer_idx, ...] = wo  # pytype: disable=unsupported-operands
+      prefix = f"layers.{layer_idx}.feed_forward"
+      _write_shards(stacked.wi_0[:, layer_idx, ...], (_as_np(var[f"{prefix}.w1.weight"]).T for var in chkpt_vars), axis=1)
+      _write_shards(stacked.wi_1[:, layer_idx, ...], (_as_np(var[f"{prefix}.w3.weight"]).T for var in chkpt_vars), axis=1)
+      _write_shards(stacked.wo[:, layer_idx, ...], (_as_np(var[f"{prefix}.w2.weight"]).T for var in chkpt_vars), axis=0)
+      for var in chkpt_vars:
+        for w in ("w1", "w2", "w3"):
+          var.pop(f"{prefix}.{w}.weight")
     else:
-      gate = np.concatenate(
-          [var[f"layers.{layer_idx}.feed_forward.gate.weight"].type(torch.float16).numpy() for var in chkpt_vars], axis=0
-      ).transpose()
-      if layer_weight["gate"]["kernel"] is None:
-        stack_shape = (base_num_decoder_layers,)
-        layer_weight["gate"]["kernel"] = np.zeros(stack_shape + gate.shape, dtype=np.float16)
-      layer_weight["gate"]["kernel"][layer_idx, ...] = gate
-      for k in tqdm(range(num_experts), desc="experts", leave=False):
-        wi_0 = np.concatenate(
-            [
-                var[f"layers.{layer_idx}.feed_forward.experts.{k}.w1.weight"].type(torch.float16).numpy()
-                for var in chkpt_vars
-            ],
-            axis=0,
-        ).transpose()
-        wi_1 = np.concatenate(
-            [
-                var[f"layers.{layer_idx}.feed_forward.experts.{k}.w3.weight"].type(torch.float16).numpy()
-                for var in chkpt_vars
-            ],
-            axis=0,
-        ).transpose()
-        wo = np.concatenate(
-            [
-                var[f"layers.{layer_idx}.feed_forward.experts.{k}.w2.weight"].type(torch.float16).numpy()
-                for var in chkpt_vars
-            ],
-            axis=1,
-        ).transpose()
-        if layer_weight["mlp"]["wi_0"]["kernel"] is None:
-          stack_shape = (num_experts, base_num_decoder_layers)
-          layer_weight["mlp"]["wi_0"]["kernel"] = np.zeros(stack_shape + wi_0.shape, dtype=np.float16)
-          layer_weight["mlp"]["wi_1"]["kernel"] = np.zeros(stack_shape + wi_1.shape, dtype=np.float16)
-          layer_weight["mlp"]["wo"]["kernel"] = np.zeros(stack_shape + wo.shape, dtype=np.float16)
-        ei, li = k, layer_idx
-        layer_weight["mlp"]["wi_0"]["kernel"][ei, li, ...] = wi_0
-        layer_weight["mlp"]["wi_1"]["kernel"][ei, li, ...] = wi_1
-        layer_weight["mlp"]["wo"]["kernel"][ei, li, ...] = wo
-      gc.collect()
-  logging.debug("Memory usage: %f GB", mem_info.memory_info().rss / (1024**3))
-
-  if num_experts is None:
-    # swap the layer index
-    layer_weight["mlp"]["wi_0"]["kernel"] = np.transpose(layer_weight["mlp"]["wi_0"]["kernel"], axes=(1, 0, 2))
-    layer_weight["mlp"]["wi_1"]["kernel"] = np.transpose(layer_weight["mlp"]["wi_1"]["kernel"], axes=(1, 0, 2))
-    layer_weight["mlp"]["wo"]["kernel"] = np.transpose(layer_weight["mlp"]["wo"]["kernel"], axes=(1, 0, 2))
+      # [num_experts, embed] => [embed, num_experts]
+      _write_shards(
+          stacked.gate[:, layer_idx, ...],
+          (_as_np(var.pop(f"layers.{layer_idx}.feed_forward.gate.weight")).T for var in chkpt_vars),
+          axis=1,
+      )
+      # the experts only write their own slices, so they are converted concurrently as well
+      with concurrent.futures.ThreadPoolExecutor(max_workers=min(MAX_EXPERT_THREADS, num_experts)) as expert_executor:
+        list(expert_executor.map(functools.partial(convert_expert, layer_idx), range(num_experts)))
 
-    jax_weights["decoder"]["layers"]["mlp"] = layer_weight["mlp"]
-  else:
-    layer_weight["gate"]["kernel"] = np.transpose(layer_weight["gate"]["kernel"], axes=(1, 0, 2))
-    jax_weights["decoder"]["layers"]["MoeBlock_0"]["gate"]["kernel"] = layer_weight["gate"]["kernel"]
+  _map_layers(convert_mlp, base_num_decoder_layers)
 
-    jax_weights["decoder"]["layers"]["MoeBlock_0"]["wi_0"] = layer_weight["mlp"]["wi_0"]["kernel"]
-    jax_weights["decoder"]["layers"]["MoeBlock_0"]["wi_1"] = layer_weight["mlp"]["wi_1"]["kernel"]
-    jax_weights["decoder"]["layers"]["MoeBlock_0"]["wo"] = layer_weight["mlp"]["wo"]["kernel"]
+  stacked.wi_0, stacked.wi_1, stacked.wo = finish(stacked.wi_0), finish(stacked.wi_1), finish(stacked.wo)
+  if stacked.gate is not None:
+    stacked.gate = finish(stacked.gate)
+  jax_weights["decoder"]["layers"].update(stacked.to_jax_weights())
   logging.debug("Memory usage: %f GB", mem_info.memory_info().rss / (1024**3))
 
   del chkpt_vars
@@ -935,7 +1128,9 @@ def _convert_pytorch_to_jax_weights(base_model_path, model_size, model_params, m
   return jax_weights
 
 
-def convert_to_jax_weights(base_model_path, model_size, huggingface_ckpt):
+def convert_to_jax_weights(
+    base_model_path, model_size, huggingface_ckpt, mmap_dir=None, device_count=None, staging_dir=None
+):
   """
   Function to convert the checkpoint at base_model_path into Orbax checkpoint
   for MaxText and output jax_weights ready for MaxText
@@ -943,6 +1138,11 @@ def convert_to_jax_weights(base_model_path, model_size, huggingface_ckpt):
   Attributes:
   base_model_path: checkpoint path
   model_size: llama2-7b to 70b, mistral-7b, or mixtral-8x7b, mixtral-8x22b
+  mmap_dir: optional directory to memory map the stacked layer weights in, it must outlive the returned weights
+  device_count: optional number of devices to put the PyTorch checkpoint weights on as each one is converted,
+    see checkpoint_device_put
+  staging_dir: directory a gs:// Huggingface checkpoint is downloaded under, the system temp dir by default, it
+    needs free space for the whole checkpoint (about 800 GB for llama3.1-405b)
   """
   """Convert model to maxtext."""
   model_params = MODEL_PARAMS_DICT[model_size]
@@ -952,9 +1152,36 @@ def convert_to_jax_weights(base_model_path, model_size, huggingface_ckpt):
   max_logging.log(f"Loading the base model from {base_model_path}")
 
   if huggingface_ckpt:
-    return _convert_huggingface_to_jax_weights(base_model_path, model_size, model_params, mem_info)
+    if base_model_path.startswith("gs://"):
+      # stage the shards locally with large concurrent range reads, safetensors needs random access to them
+      with tempfile.TemporaryDirectory(dir=staging_dir) as local_model_path:
+        if not gcs_utils.download_blobs_concurrently(base_model_path, local_model_path, suffix=".safetensors"):
+          raise ValueError(f"No .safetensors checkpoint files found in {base_model_path}.")
+        # the staged shards are deleted on return, so no weight may stay a view of them
+        return _convert_huggingface_to_jax_weights(
+            local_model_path, model_size, model_params, mem_info, mmap_dir, copy_views=True
+        )
+    return _convert_huggingface_to_jax_weights(base_model_path, model_size, model_params, mem_info, mmap_dir)
+
+  return _convert_pytorch_to_jax_weights(base_model_path, model_size, model_params, mem_info, mmap_dir, device_count)
 
-  return _convert_pytorch_to_jax_weights(base_model_path, model_size, model_params, mem_info)
+
+def checkpoint_device_put(arr, device_count):
+  """Puts a weight on the devices, sharded along its first or else second axis when it divides evenly."""
+  mesh = jax.sharding.Mesh(jax.devices(), "checkpoint_sharding_axis")
+  if arr.shape[0] % device_count == 0:
+    max_logging.log("sharding first axis")
+    # shards first axis
+    sharding = jax.sharding.NamedSharding(mesh, jax.sharding.PartitionSpec("checkpoint_sharding_axis"))
+  elif len(arr.shape) > 1 and arr.shape[1] % device_count == 0:
+    max_logging.log("sharding second axis")
+    # shards second axis
+    sharding = jax.sharding.NamedSharding(mesh, jax.sharding.PartitionSpec(None, "checkpoint_sharding_axis"))
+  else:
+    max_logging.log("no sharding was possible, replicating")
+    # no sharding
+    sharding = jax.sharding.NamedSharding(mesh, jax.sharding.PartitionSpec(None))
+  return jax.device_put(arr, device=sharding)
 
 
 def save_weights_to_checkpoint(maxtext_model_path, jax_weights, device_count, use_ocdbt, use_zarr3):
@@ -969,31 +1196,25 @@ def save_weights_to_checkpoint(maxtext_model_path, jax_weights, device_count, us
   mem_info = psutil.Process()
   logging.debug("Memory usage: %f GB", mem_info.memory_info().rss / (1024**3))
   gc.collect()
-  mesh = jax.sharding.Mesh(jax.devices(), "checkpoint_sharding_axis")
-  s1 = jax.sharding.NamedSharding(mesh, jax.sharding.PartitionSpec("checkpoint_sharding_axis"))  # shards first axis
-  s2 = jax.sharding.NamedSharding(mesh, jax.sharding.PartitionSpec(None, "checkpoint_sharding_axis"))  # shards second axis
-  s3 = jax.sharding.NamedSharding(mesh, jax.sharding.PartitionSpec(None))  # no sharding
-
-  def checkpoint_device_put(arr):
-    if arr.shape[0] % device_count == 0:
-      max_logging.log("sharding first axis")
-      return jax.device_put(arr, device=s1)
-    elif len(arr.shape) > 1 and arr.shape[1] % device_count == 0:
-      max_logging.log("sharding second axis")
-      return jax.device_put(arr, device=s2)
-    else:
-      max_logging.log("no sharding was possible, replicating")
-      return jax.device_put(arr, device=s3)
 
-  # convert all weights to jax.numpy with sharding if applicable
+  # convert all weights to jax.numpy with sharding if applicable, weights already put on the devices are kept
   jax_weights_flat, jax_weights_struct = tree.flatten(jax_weights)
+  jax_weights_flat = deque(jax_weights_flat)
+  # drop this function's references to the host weights as they are put on the devices, so a weight the caller
+  # doesn't also hold on to (as with the base weights passed straight in by the CLI) is freed right after its transfer
+  del jax_weights
   jax_weights_new = []
   while len(jax_weights_flat) > 0:
-    jax_weight = jax_weights_flat.pop(0)
-    jax_weights_new.append(checkpoint_device_put(jax_weight))
+    jax_weight = jax_weights_flat.popleft()
+    jax_weights_new.append(checkpoint_device_put(jax_weight, device_count))
     del jax_weight
-    gc.collect()
-    logging.debug("Memory usage: %f GB", mem_info.memory_info().rss / (1024**3))
+    # the transfers are asynchronous, so the next weights are dispatched while the previous ones are still copied
+    if len(jax_weights_new) % DEVICE_PUT_BATCH_SIZE == 0:
+      jax.block_until_ready(jax_weights_new[-DEVICE_PUT_BATCH_SIZE:])
+      logging.debug("Memory usage: %f GB", mem_info.memory_info().rss / (1024**3))
+  jax.block_until_ready(jax_weights_new)
+  gc.collect()
+  logging.debug("Memory usage: %f GB", mem_info.memory_info().rss / (1024**3))
 
   jax_weights = tree.unflatten(jax_weights_struct, jax_weights_new)
 
@@ -1056,6 +1277,10 @@ if __name__ == "__main__":
   parser.add_argument("--huggingface-checkpoint", type=bool, required=False, default=False)
   parser.add_argument("--use-ocdbt", type=bool, required=False, default=True)
   parser.add_argument("--use-zarr3", type=bool, required=False, default=True)
+  # memory maps the stacked layer weights under this directory, for models that don't fit in host memory
+  parser.add_argument("--stacked-weights-dir", type=str, required=False)
+  # a gs:// Huggingface checkpoint is downloaded under this directory, it needs free space for the whole checkpoint
+  parser.add_argument("--checkpoint-staging-dir", type=str, required=False)
   args = parser.parse_args()
 
   if args.model_size not in MODEL_PARAMS_DICT:
@@ -1067,13 +1292,23 @@ if __name__ == "__main__":
   if args.lora_input_adapters_path:
     base_weights_path += "/base"
 
-  save_weights_to_checkpoint(
-      args.maxtext_model_path,
-      convert_to_jax_weights(args.base_model_path, args.model_size, args.huggingface_checkpoint),
-      SIMULATED_CPU_DEVICES_COUNT,
-      args.use_ocdbt,
-      args.use_zarr3,
-  )
+  with (
+      tempfile.TemporaryDirectory(dir=args.stacked_weights_dir) if args.stacked_weights_dir else contextlib.nullcontext()
+  ) as stacked_weights_dir:
+    save_weights_to_checkpoint(
+        args.maxtext_model_path,
+        convert_to_jax_weights(
+            args.base_model_path,
+            args.model_size,
+            args.huggingface_checkpoint,
+            stacked_weights_dir,
+            SIMULATED_CPU_DEVICES_COUNT,
+            args.checkpoint_staging_dir,
+        ),
+        SIMULATED_CPU_DEVICES_COUNT,
+        args.use_ocdbt,
+        args.use_zarr3,
+    )
   max_logging.log(f"Successfully saved base_weights to {base_weights_path}.")
 
   if args.lora_input_adapters_path:
@@ -1096,7 +1331,9 @@ if __name__ == "__main__":
         lora_config_dict = json.load(file)
 
         if lora_config_dict is not None:
-          lora_model_path = f"{lora_path}/adapter_model.bin"
+          lora_model_path = f"{lora_path}/adapter_model.safetensors"
+          if not os.path.exists(lora_model_path):
+            lora_model_path = f"{lora_path}/adapter_model.bin"
           lora_config_dict["lora_model_path"] = lora_model_path
 
           jax_lora_weights = convert_lora_weights_to_jax_weights(lora_config_dict, args.model_size)
@@ -0,0 +1,360 @@
+"""
+Copyright 2025 Google LLC
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+     https://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+""" Tests for the llama and mistral checkpoint conversion """
+
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import jax
+from jax import tree
+import numpy as np
+import pytest
+
+# the converter and these tests need torch and safetensors, which are not in requirements.txt
+torch = pytest.importorskip("torch")
+pytest.importorskip("safetensors")
+
+from safetensors import safe_open  # pylint: disable=wrong-import-position
+from safetensors import numpy as safetensors_numpy  # pylint: disable=wrong-import-position
+from safetensors.torch import save_file  # pylint: disable=wrong-import-position
+
+import llama_or_mistral_ckpt  # pylint: disable=wrong-import-position
+from max_utils import permute_to_match_maxtext_rope  # pylint: disable=wrong-import-position
+
+_MLP_DIM = 24
+_VOCAB_PADDING = 4
+_TEST_MODEL_PARAMS = {
+    "llama2-test": {"num_layers": 3, "num_heads": 4, "num_kv_heads": 4, "dims_per_head": 8, "vocab": 40},
+    "llama3.1-test": {"num_layers": 3, "num_heads": 4, "num_kv_heads": 2, "dims_per_head": 8, "vocab": 48},
+    "mixtral-test": {"num_layers": 2, "num_heads": 4, "num_kv_heads": 2, "dims_per_head": 8, "vocab": 40, "num_experts": 3},
+}
+
+
+def _make_weights(model_size):
+  """Random bf16 weights of a tiny model in the PyTorch naming convention."""
+  params = _TEST_MODEL_PARAMS[model_size]
+  num_heads, num_kv_heads, head_dim = params["num_heads"], params["num_kv_heads"], params["dims_per_head"]
+  embed_dim = num_heads * head_dim
+  generator = torch.Generator().manual_seed(0)
+
+  def rand(*shape):
+    return torch.randn(*shape, generator=generator).to(torch.bfloat16)
+
+  vocab = params["vocab"] + _VOCAB_PADDING
+  weights = {
+      "tok_embeddings.weight": rand(vocab, embed_dim),
+      "norm.weight": rand(embed_dim),
+      "output.weight": rand(vocab, embed_dim),
+  }
+  for i in range(params["num_layers"]):
+    prefix = f"layers.{i}"
+    weights[f"{prefix}.attention.wq.weight"] = rand(num_heads * head_dim, embed_dim)
+    weights[f"{prefix}.attention.wk.weight"] = rand(num_kv_heads * head_dim, embed_dim)
+    weights[f"{prefix}.attention.wv.weight"] = rand(num_kv_heads * head_dim, embed_dim)
+    weights[f"{prefix}.attention.wo.weight"] = rand(embed_dim, num_heads * head_dim)
+    weights[f"{prefix}.attention_norm.weight"] = rand(embed_dim)
+    weights[f"{prefix}.ffn_norm.weight"] = rand(embed_dim)
+    if "num_experts" in params:
+      weights[f"{prefix}.feed_forward.gate.weight"] = rand(params["num_experts"], embed_dim)
+      for k in range(params["num_experts"]):
+        weights[f"{prefix}.feed_forward.experts.{k}.w1.weight"] = rand(_MLP_DIM, embed_dim)
+        weights[f"{prefix}.feed_forward.experts.{k}.w3.weight"] = rand(_MLP_DIM, embed_dim)
+        weights[f"{prefix}.feed_forward.experts.{k}.w2.weight"] = rand(embed_dim, _MLP_DIM)
+    else:
+      weights[f"{prefix}.feed_forward.w1.weight"] = rand(_MLP_DIM, embed_dim)
+      weights[f"{prefix}.feed_forward.w3.weight"] = rand(_MLP_DIM, embed_dim)
+      weights[f"{prefix}.feed_forward.w2.weight"] = rand(embed_dim, _MLP_DIM)
+  return weights
+
+
+def _split_weights(model_size, weights, num_shards):
+  """Splits the weights the way the Meta checkpoints are sharded, with the norms replicated in every shard."""
+  shards = [{} for _ in range(num_shards)]
+  for key, weight in weights.items():
+    if weight.ndim == 1:
+      chunks = [weight] * num_shards
+    elif key.endswith(("wo.weight", "w2.weight")) or (key == "tok_embeddings.weight" and model_size[:6] != "llama3"):
+      chunks = torch.chunk(weight, num_shards, dim=1)
+    else:
+      chunks = torch.chunk(weight, num_shards, dim=0)
+    for shard, chunk in zip(shards, chunks):
+      # cloned so each shard only saves its own slice of the storage
+      shard[key] = chunk.clone()
+  return shards
+
+
+def _save_shards(ckpt_dir, shards):
+  """Saves the shards as the consolidated.*.pth files of a Meta checkpoint."""
+  for i, shard in enumerate(shards):
+    torch.save(shard, os.path.join(ckpt_dir, f"consolidated.{i:02d}.pth"))
+
+
+def _permute_to_match_maxtext_rope(arr):
+  """The rope permutation of the original PyTorch conversion, which moves the evens of head_dim before the odds."""
+  evens = arr[..., ::2]
+  odds = arr[..., 1::2]
+  return np.concatenate((evens, odds), axis=arr.ndim - 1)
+
+
+def _hf_key(key):
+  """The Huggingface name of a weight in the PyTorch naming convention."""
+  match = llama_or_mistral_ckpt._LAYER_EXPERT_RE.search(key)  # pylint: disable=protected-access
+  if match is None:
+    return llama_or_mistral_ckpt._hf_mapping()[key]  # pylint: disable=protected-access
+  layer_idx, expert_idx = match.groups()
+  return llama_or_mistral_ckpt._hf_mapping(  # pylint: disable=protected-access
+      int(layer_idx), -1 if expert_idx is None else int(expert_idx)
+  )[key]
+
+
+def _reference_weights(model_size, shards, permute_rope):
+  """The per layer concatenate, transpose and permute of the original conversion, in float32.
+
+  permute_rope, if given, is applied to the query and key weights.
+  """
+  params = _TEST_MODEL_PARAMS[model_size]
+  num_layers, num_heads, head_dim = params["num_layers"], params["num_heads"], params["dims_per_head"]
+  num_kv_heads, vocab_size, num_experts = params["num_kv_heads"], params["vocab"], params.get("num_experts")
+
+  def concat(key, axis):
+    return np.concatenate([shard[key].float().numpy() for shard in shards], axis=axis)
+
+  def stack(fn):
+    return np.stack([fn(layer_idx) for layer_idx in range(num_layers)])
+
+  if model_size[:6] == "llama3":
+    token_embedder = concat("tok_embeddings.weight", axis=0)
+  else:
+    token_embedder = concat("tok_embeddings.weight", axis=1)[:vocab_size, :]
+
+  def attention(layer_idx, name, heads, permute):
+    w = concat(f"layers.{layer_idx}.attention.{name}.weight", axis=0).transpose()
+    w = np.reshape(w, [num_heads * head_dim, heads, head_dim])
+    return permute_rope(w) if permute and permute_rope else w
+
+  query = stack(lambda i: attention(i, "wq", num_heads, True)).transpose(1, 0, 2, 3) / np.sqrt(head_dim)
+  key = stack(lambda i: attention(i, "wk", num_kv_heads, True)).transpose(1, 0, 2, 3)
+  value = stack(lambda i: attention(i, "wv", num_kv_heads, False)).transpose(1, 0, 2, 3)
+  out = stack(
+      lambda i: np.reshape(concat(f"layers.{i}.attention.wo.weight", axis=1), [num_heads * head_dim, num_heads, head_dim])
+  ).transpose(2, 0, 3, 1)
+
+  layers = {
+      "self_attention": {
+          "query": {"kernel": query},
+          "key": {"kernel": key},
+          "value": {"kernel": value},
+          "out": {"kernel": out},
+      },
+      "pre_self_attention_layer_norm": {
+          "scale": stack(lambda i: shards[0][f"layers.{i}.attention_norm.weight"].float().numpy()).T
+      },
+      "post_self_attention_layer_norm": {
+          "scale": stack(lambda i: shards[0][f"layers.{i}.ffn_norm.weight"].float().numpy()).T
+      },
+  }
+
+  def mlp(prefix):
+    return (
+        concat(f"{prefix}.w1.weight", axis=0).transpose(),
+        concat(f"{prefix}.w3.weight", axis=0).transpose(),
+        concat(f"{prefix}.w2.weight", axis=1).transpose(),
+    )
+
+  if num_experts is None:
+    wi_0, wi_1, wo = (
+        np.stack(w).transpose(1, 0, 2) for w in zip(*(mlp(f"layers.{i}.feed_forward") for i in range(num_layers)))
+    )
+    layers["mlp"] = {"wi_0": {"kernel": wi_0}, "wi_1": {"kernel": wi_1}, "wo": {"kernel": wo}}
+  else:
+    gate = stack(lambda i: concat(f"layers.{i}.feed_forward.gate.weight", axis=0).transpose()).transpose(1, 0, 2)
+    experts = [[mlp(f"layers.{i}.feed_forward.experts.{k}") for i in range(num_layers)] for k in range(num_experts)]
+    wi_0, wi_1, wo = (np.array([[layer[j] for layer in expert] for expert in experts]) for j in range(3))
+    layers["MoeBlock_0"] = {"gate": {"kernel": gate}, "wi_0": wi_0, "wi_1": wi_1, "wo": wo}
+
+  return {
+      "decoder": {
+          "layers": layers,
+          "decoder_norm": {"scale": shards[0]["norm.weight"].float().numpy()},
+          "logits_dense": {"kernel": concat("output.weight", axis=0).transpose()[:, :vocab_size]},
+      },
+      "token_embedder": {"embedding": token_embedder},
+  }
+
+
+class LlamaOrMistralCkptTest(unittest.TestCase):
+  """Compares the PyTorch and Huggingface checkpoint conversions against the original per layer conversions."""
+
+  def setUp(self):
+    super().setUp()
+    patcher = mock.patch.dict(llama_or_mistral_ckpt.MODEL_PARAMS_DICT, _TEST_MODEL_PARAMS)
+    patcher.start()
+    self.addCleanup(patcher.stop)
+
+  def _assert_weights_equal(self, expected, actual, path=""):
+    """Walks both trees, the query kernel is compared with a bf16 tolerance and every other weight exactly."""
+    self.assertEqual(set(expected), set(actual), path)
+    for name, expected_value in expected.items():
+      if isinstance(expected_value, dict):
+        self._assert_weights_equal(expected_value, actual[name], f"{path}/{name}")
+        continue
+      actual_value = np.asarray(actual[name]).astype(np.float32)
+      self.assertEqual(expected_value.shape, actual_value.shape, f"{path}/{name}")
+      if path.endswith("query"):
+        np.testing.assert_allclose(actual_value, expected_value, rtol=1e-2, err_msg=f"{path}/{name}")
+      else:
+        np.testing.assert_array_equal(actual_value, expected_value, err_msg=f"{path}/{name}")
+
+  def _assert_matches_reference(self, model_size, num_shards=2):
+    """Converts a checkpoint of model_size split into num_shards .pth files and compares it to the reference."""
+    shards = _split_weights(model_size, _make_weights(model_size), num_shards)
+    # the Meta checkpoints other than llama3 have their rope weights permuted
+    permute_rope = _permute_to_match_maxtext_rope if model_size[:8] not in llama_or_mistral_ckpt.llama3_variants else None
+    expected = _reference_weights(model_size, shards, permute_rope)
+    with tempfile.TemporaryDirectory() as ckpt_dir:
+      _save_shards(ckpt_dir, shards)
+      actual = llama_or_mistral_ckpt.convert_to_jax_weights(ckpt_dir, model_size, False)
+      # checked before the directory is removed, since single shard weights are views of the memory mapped .pth
+      self._assert_weights_equal(expected, actual)
+
+  def _assert_hf_matches_reference(self, model_size):
+    """Converts a Huggingface checkpoint of model_size split into two safetensors files and compares it to the reference."""
+    weights = _make_weights(model_size)
+    # the Huggingface llama3.1 checkpoints have their rope weights permuted
+    permute_rope = permute_to_match_maxtext_rope if model_size[:8] == "llama3.1" else None
+    expected = _reference_weights(model_size, [weights], permute_rope)
+    keys = list(weights)
+    with tempfile.TemporaryDirectory() as ckpt_dir:
+      for i, file_keys in enumerate((keys[::2], keys[1::2])):
+        path = os.path.join(ckpt_dir, f"model-{i + 1:05d}-of-00002.safetensors")
+        # stored as F32, which is read back as bf16 without a rounding since the weights are bf16 values
+        safetensors_numpy.save_file({_hf_key(key): weights[key].float().numpy() for key in file_keys}, path)
+      actual = llama_or_mistral_ckpt.convert_to_jax_weights(ckpt_dir, model_size, True)
+      # checked before the directory is removed, since the embedding and norms are views of the memory mapped shards
+      self._assert_weights_equal(expected, actual)
+
+  def test_llama2_conversion_matches_reference(self):
+    self._assert_matches_reference("llama2-test")
+
+  def test_llama3_conversion_matches_reference(self):
+    self._assert_matches_reference("llama3.1-test")
+
+  def test_mixtral_conversion_matches_reference(self):
+    self._assert_matches_reference("mixtral-test")
+
+  def test_single_shard_conversion_matches_reference(self):
+    self._assert_matches_reference("llama2-test", num_shards=1)
+
+  def test_hf_llama2_conversion_matches_reference(self):
+    self._assert_hf_matches_reference("llama2-test")
+
+  def test_hf_llama3_conversion_matches_reference(self):
+    self._assert_hf_matches_reference("llama3.1-test")
+
+  def test_hf_mixtral_conversion_matches_reference(self):
+    self._assert_hf_matches_reference("mixtral-test")
+
+  def test_mmap_dir_conversion_matches_in_memory(self):
+    model_size = "mixtral-test"
+    with tempfile.TemporaryDirectory() as ckpt_dir, tempfile.TemporaryDirectory() as mmap_dir:
+      _save_shards(ckpt_dir, _split_weights(model_size, _make_weights(model_size), 2))
+      expected = llama_or_mistral_ckpt.convert_to_jax_weights(ckpt_dir, model_size, False)
+      actual = llama_or_mistral_ckpt.convert_to_jax_weights(ckpt_dir, model_size, False, mmap_dir=mmap_dir)
+
+      # the stacked layer kernels are files in mmap_dir
+      moe = actual["decoder"]["layers"]["MoeBlock_0"]
+      for kernel in (actual["decoder"]["layers"]["self_attention"]["query"]["kernel"], moe["wi_0"], moe["gate"]["kernel"]):
+        self.assertIsInstance(kernel, np.memmap)
+        self.assertEqual(os.path.dirname(kernel.filename), os.path.realpath(mmap_dir))
+      tree.map(np.testing.assert_array_equal, expected, actual)
+
+  def test_device_count_conversion_matches_in_memory(self):
+    model_size = "llama2-test"
+    with tempfile.TemporaryDirectory() as ckpt_dir:
+      _save_shards(ckpt_dir, _split_weights(model_size, _make_weights(model_size), 2))
+      expected = llama_or_mistral_ckpt.convert_to_jax_weights(ckpt_dir, model_size, False)
+      actual = llama_or_mistral_ckpt.convert_to_jax_weights(ckpt_dir, model_size, False, device_count=1)
+
+      # every weight is put on the devices as it is finished
+      for arr in tree.leaves(actual):
+        self.assertIsInstance(arr, jax.Array)
+      tree.map(lambda x, y: np.testing.assert_array_equal(x, np.asarray(y)), expected, actual)
+
+  def test_incomplete_shards_raise(self):
+    dest = np.empty((4, 6), dtype=np.float32)
+    with self.assertRaisesRegex(ValueError, "cover 4 of the 6 entries along axis 1"):
+      llama_or_mistral_ckpt._write_shards(dest, [np.ones((4, 2)), np.ones((4, 2))], axis=1)  # pylint: disable=protected-access
+
+
+class LayerShapesTest(unittest.TestCase):
+  """Checks the attention write plan against the permutations it folds into its copies."""
+
+  def test_llama3_1_layer_write_matches_permute_to_match_maxtext_rope(self):
+    num_layers, num_heads, num_kv_heads, head_dim = 3, 4, 2, 8
+    embed_dim = num_heads * head_dim
+    shapes = llama_or_mistral_ckpt._layer_shapes(  # pylint: disable=protected-access
+        num_heads, head_dim, embed_dim, rope_split=(2, head_dim // 2)
+    )
+
+    rng = np.random.default_rng(0)
+    for write, heads in ((shapes.query, num_heads), (shapes.key, num_kv_heads)):
+      layer_idx = 1
+      weight = rng.standard_normal((heads * head_dim, embed_dim), dtype=np.float32)
+      stacked = np.zeros((embed_dim, num_layers, heads, head_dim), dtype=np.float32)
+      write.write(stacked, layer_idx, weight)
+
+      expected = permute_to_match_maxtext_rope(np.reshape(weight.transpose(), [embed_dim, heads, head_dim]))
+      np.testing.assert_array_equal(stacked[:, layer_idx, ...], expected)
+      # the other layers of the stacked kernel are left untouched
+      np.testing.assert_array_equal(np.delete(stacked, layer_idx, axis=1), 0)
+
+
+class SafetensorsIndexTest(unittest.TestCase):
+  """Compares the safetensors header parser against safe_open."""
+
+  def test_read_matches_safe_open(self):
+    generator = torch.Generator().manual_seed(0)
+    tensors = {
+        "model.norm.weight": torch.randn(16, generator=generator).to(torch.bfloat16),
+        "model.layers.0.self_attn.q_proj.weight": torch.randn(16, 8, generator=generator).to(torch.bfloat16),
+        "lm_head.weight": torch.randn(24, 16, generator=generator),
+    }
+    with tempfile.TemporaryDirectory() as ckpt_dir:
+      path = os.path.join(ckpt_dir, "model-00001-of-00001.safetensors")
+      save_file(tensors, path, metadata={"format": "pt"})
+      index = llama_or_mistral_ckpt._index_safetensors([path])  # pylint: disable=protected-access
+      self.assertEqual(set(index), {"norm.weight", "layers.0.attention.wq.weight", "output.weight"})
+
+      with safe_open(path, framework="pt", device="cpu") as f:
+        for hf_key in f.keys():
+          arr = index[llama_or_mistral_ckpt._hf_to_maxtext_key(hf_key)].read()  # pylint: disable=protected-access
+          expected = f.get_tensor(hf_key).to(torch.bfloat16).float().numpy()
+          self.assertEqual(arr.dtype, llama_or_mistral_ckpt.SAVE_DTYPE)
+          np.testing.assert_array_equal(arr.astype(np.float32), expected)
+
+  def test_unsupported_dtype_raises(self):
+    with tempfile.TemporaryDirectory() as ckpt_dir:
+      path = os.path.join(ckpt_dir, "model-00001-of-00001.safetensors")
+      save_file({"model.norm.weight": torch.arange(16, dtype=torch.int64)}, path)
+      with self.assertRaisesRegex(ValueError, "Unsupported dtype I64 of `model.norm.weight`"):
+        llama_or_mistral_ckpt._index_safetensors([path])  # pylint: disable=protected-access
+
+
+if __name__ == "__main__":
+  unittest.main()